@@ -0,0 +1,5 @@
+# Бенчмарки реализаций bson из tasks/*. Запуск из каталога 05.1.HW1-Bson:
+#   python -m benchmarks.run --output report.json
+#   python -m benchmarks.bench_marshal
+#   python -m benchmarks.bench_dispatch --baseline HEAD~1
+#   python -m benchmarks.bench_aio
@@ -0,0 +1,93 @@
+# Задержка туда-обратно и пропускная способность обмена документами через asyncio:
+# клиент на потоках (read_document/write_document) и клиент на BsonProtocol против локального эхо-сервера.
+# Запуск из 05.1.HW1-Bson: python -m benchmarks.bench_aio [--messages N] [--size BYTES] [--window N]
+
+import argparse
+import asyncio
+import statistics
+import time
+from types import ModuleType
+from typing import Any, Awaitable, Callable, Dict, List
+
+from .variants import load_variant
+
+
+def make_message(size: int) -> Dict[str, Any]:
+    return {'id': 0, 'kind': 'echo', 'payload': 'x' * size, 'values': list(range(16))}
+
+
+async def echo_server(bson: ModuleType, finished: asyncio.Event) -> asyncio.Server:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while (doc := await bson.read_document(reader)) is not None:
+            await bson.write_document(writer, doc)
+        writer.close()
+        finished.set()
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+async def streams_client(bson: ModuleType, port: int) -> tuple[Callable[[Any], None], Callable[[], Awaitable[Any]],
+                                                               Callable[[], None]]:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    return (lambda doc: writer.write(bson.marshal(doc)), lambda: bson.read_document(reader), writer.close)
+
+
+async def protocol_client(bson: ModuleType, port: int) -> tuple[Callable[[Any], None], Callable[[], Awaitable[Any]],
+                                                                Callable[[], None]]:
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_connection(bson.BsonProtocol, '127.0.0.1', port)
+    return protocol.send, protocol.recv, transport.close
+
+
+async def measure(bson: ModuleType, client: Any, messages: int, size: int, window: int) -> None:
+    finished = asyncio.Event()
+    server = await echo_server(bson, finished)
+    port = server.sockets[0].getsockname()[1]
+    send, recv, close = await client(bson, port)
+    doc = make_message(size)
+
+    # Задержка: один документ в полете
+    latencies: List[float] = []
+    for i in range(messages // 10):
+        doc['id'] = i
+        start = time.perf_counter()
+        send(doc)
+        assert (await recv())['id'] == i
+        latencies.append(time.perf_counter() - start)
+
+    # Пропускная способность: до window документов в полете
+    start = time.perf_counter()
+    sent = received = 0
+    while received < messages:
+        while sent < messages and sent - received < window:
+            doc['id'] = sent
+            send(doc)
+            sent += 1
+        await recv()
+        received += 1
+    elapsed = time.perf_counter() - start
+
+    close()
+    await finished.wait()
+    server.close()
+    await server.wait_closed()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f'{client.__name__:>16}: p50 {statistics.median(latencies) * 1e6:8.1f} us  '
+          f'p99 {p99 * 1e6:8.1f} us  {messages / elapsed:9.0f} msg/s')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--window', type=int, default=64)
+    args = parser.parse_args()
+
+    bson = load_variant('strict_out')
+    for client in (streams_client, protocol_client):
+        asyncio.run(measure(bson, client, args.messages, args.size, args.window))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# Скорость выбора кодировщика элемента: текущий strict_out против версии из указанной git-ревизии
+# Запуск из 05.1.HW1-Bson: python -m benchmarks.bench_dispatch --baseline REV [--docs N] [--repeat N]
+# Версия до реестра кодировщиков в Mapper - родитель коммита, который его ввел:
+#   --baseline "$(git log --format=%h --grep='per-instance type-to-encoder registry')^"
+
+import argparse
+import timeit
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+from .variants import load_revision, load_variant
+
+
+def make_mixed(n: int) -> List[Dict[str, Any]]:
+    dt = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        {
+            's': f'name-{i}', 'i': i, 'big': i << 40, 'f': i / 3, 'b': i % 2 == 0, 'n': None,
+            'bin': bytes(8), 'dt': dt, 'l': [i, 'x', 1.0, True], 'd': {'a': i, 'b': 'y', 'c': None},
+        }
+        for i in range(n)
+    ]
+
+
+def count_elements(data: Any) -> int:
+    if isinstance(data, dict):
+        return sum(1 + count_elements(v) for v in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(1 + count_elements(v) for v in data)
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    # Хеш ревизии меняется при rebase, поэтому базу сравнения указываем явно
+    parser.add_argument('--baseline', required=True)
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    docs = make_mixed(args.docs)
+    elements = sum(count_elements(d) for d in docs)
+    for name, module in ((args.baseline, load_revision(args.baseline)), ('current', load_variant('strict_out'))):
+        marshal = module.marshal
+        best = min(timeit.repeat(lambda: [marshal(d) for d in docs], number=1, repeat=args.repeat))
+        print(f'{name:>10}: {elements / best / 1e6:6.3f} M elements/s')
+
+
+if __name__ == '__main__':
+    main()
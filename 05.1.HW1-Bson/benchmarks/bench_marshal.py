@@ -0,0 +1,46 @@
+# Сравнение скорости marshal: старый путь Element/Document (mvp) против записи в один bytearray (strict_out)
+# Запуск из 05.1.HW1-Bson: python -m benchmarks.bench_marshal [--scale N] [--repeat N]
+
+import argparse
+import timeit
+from types import ModuleType
+from typing import Any, Dict
+
+from .variants import load_variant
+
+
+def make_wide(n: int) -> Dict[str, Any]:
+    return {f'key{i:07d}': ('value' * 4, i, i * 0.5, [i, str(i)]) for i in range(n)}
+
+
+def make_deep(depth: int, width: int) -> Dict[str, Any]:
+    doc: Dict[str, Any] = {'leaf': 'x' * 64}
+    for level in range(depth):
+        doc = {'child': doc, **{f'f{j}': 'y' * 32 for j in range(width)}}
+    return doc
+
+
+def bench(name: str, doc: Dict[str, Any], old: ModuleType, new: ModuleType, repeat: int) -> None:
+    size = len(new.marshal(doc))
+    assert old.marshal(doc) == new.marshal(doc)
+    old_time = min(timeit.repeat(lambda: old.marshal(doc), number=1, repeat=repeat))
+    new_time = min(timeit.repeat(lambda: new.marshal(doc), number=1, repeat=repeat))
+    mb = size / 2 ** 20
+    print(f'{name:>6}: {mb:8.2f} MB  old {mb / old_time:8.2f} MB/s  new {mb / new_time:8.2f} MB/s  '
+          f'x{old_time / new_time:.1f}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    old = load_variant('mvp')
+    new = load_variant('strict_out')
+    bench('wide', make_wide(5000 * args.scale), old, new, args.repeat)
+    bench('deep', make_deep(200, 50 * args.scale), old, new, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
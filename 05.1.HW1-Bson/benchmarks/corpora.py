@@ -0,0 +1,93 @@
+# Воспроизводимые наборы документов: каждый строится из своего random.Random(seed)
+
+import dataclasses
+import random
+import string
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List
+
+Corpus = List[Dict[str, Any]]
+
+
+@dataclasses.dataclass
+class Row:
+    id: int
+    name: str
+    score: float
+    active: bool
+
+
+def flat_floats(rnd: random.Random, scale: int) -> Corpus:
+    return [{f'f{j:03d}': rnd.uniform(-1e6, 1e6) for j in range(100)} for _ in range(200 * scale)]
+
+
+def long_strings(rnd: random.Random, scale: int) -> Corpus:
+    alphabet = string.ascii_letters + 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя' + '日本語中文'
+    return [
+        {f's{j}': ''.join(rnd.choices(alphabet, k=rnd.randint(1000, 5000))) for j in range(10)}
+        for _ in range(20 * scale)
+    ]
+
+
+def deep_nesting(rnd: random.Random, scale: int) -> Corpus:
+    docs = []
+    for _ in range(20 * scale):
+        doc: Dict[str, Any] = {'leaf': rnd.random()}
+        for level in range(rnd.randint(100, 200)):
+            doc = {'child': doc, 'level': level, 'tag': f't{rnd.randint(0, 999)}'}
+        docs.append(doc)
+    return docs
+
+
+def wide_arrays(rnd: random.Random, scale: int) -> Corpus:
+    return [
+        {'ints': [rnd.randint(-2 ** 40, 2 ** 40) for _ in range(5000)], 'floats': [rnd.random() for _ in range(5000)]}
+        for _ in range(10 * scale)
+    ]
+
+
+def binary_blobs(rnd: random.Random, scale: int) -> Corpus:
+    return [{f'b{j}': rnd.randbytes(rnd.randint(10000, 100000)) for j in range(5)} for _ in range(10 * scale)]
+
+
+def datetimes(rnd: random.Random, scale: int) -> Corpus:
+    base = datetime(2000, 1, 1, tzinfo=timezone.utc)
+    return [
+        {f'd{j:02d}': base + timedelta(milliseconds=rnd.randint(0, 10 ** 12)) for j in range(50)}
+        for _ in range(200 * scale)
+    ]
+
+
+def dataclass_rows(rnd: random.Random, scale: int) -> Corpus:
+    return [
+        {'rows': [Row(i, f'name-{rnd.randint(0, 10 ** 6)}', rnd.random(), rnd.random() < 0.5) for i in range(100)]}
+        for _ in range(50 * scale)
+    ]
+
+
+CORPORA: Dict[str, Callable[[random.Random, int], Corpus]] = {
+    'flat_floats': flat_floats,
+    'long_strings': long_strings,
+    'deep_nesting': deep_nesting,
+    'wide_arrays': wide_arrays,
+    'binary_blobs': binary_blobs,
+    'datetimes': datetimes,
+    'dataclass_rows': dataclass_rows,
+}
+
+
+def make_corpus(name: str, seed: int, scale: int = 1) -> Corpus:
+    return CORPORA[name](random.Random(f'{name}:{seed}'), scale)
+
+
+def canonical(data: Any) -> Any:
+    # То, что должно получиться после marshal/unmarshal без keep_types
+    if dataclasses.is_dataclass(data) and not isinstance(data, type):
+        return {field.name: canonical(getattr(data, field.name)) for field in dataclasses.fields(data)}
+    if isinstance(data, dict):
+        return {k: canonical(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [canonical(v) for v in data]
+    if isinstance(data, bytearray):
+        return bytes(data)
+    return data
@@ -0,0 +1,130 @@
+# Скорость и пиковая память marshal/unmarshal по вариантам задачи и наборам документов.
+# Отчет в JSON с постоянным порядком ключей, чтобы его можно было сравнивать между коммитами:
+#   python -m benchmarks.run --output new.json --compare old.json
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import timeit
+import tracemalloc
+from types import ModuleType
+from typing import Any, Callable, Dict, List
+
+from .corpora import CORPORA, Corpus, canonical, make_corpus
+from .variants import TASKS_DIR, VARIANTS, load_variant
+
+
+def git_revision() -> str:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=TASKS_DIR, capture_output=True, text=True)
+    return result.stdout.strip()
+
+
+def peak_memory(func: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(func: Callable[[], Any], docs: int, size: int, repeat: int) -> Dict[str, float]:
+    seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+    return {
+        'seconds': seconds,
+        'mb_s': size / 2 ** 20 / seconds,
+        'docs_s': docs / seconds,
+        'peak_bytes': peak_memory(func),
+    }
+
+
+def bench_variant(module: ModuleType, corpus: Corpus, repeat: int) -> Dict[str, Any]:
+    marshal, unmarshal = module.marshal, module.unmarshal
+    blobs = [marshal(doc) for doc in corpus]
+    # Без этой проверки можно намерить скорость реализации, которая молча теряет данные
+    if unmarshal(blobs[0]) != canonical(corpus[0]):
+        raise ValueError('round trip mismatch')
+    size = sum(len(blob) for blob in blobs)
+    return {
+        'docs': len(corpus),
+        'bytes': size,
+        'marshal': measure(lambda: [marshal(doc) for doc in corpus], len(corpus), size, repeat),
+        'unmarshal': measure(lambda: [unmarshal(blob) for blob in blobs], len(corpus), size, repeat),
+    }
+
+
+def run(variants: List[str], corpora: List[str], seed: int, scale: int, repeat: int) -> Dict[str, Any]:
+    results: Dict[str, Dict[str, Any]] = {}
+    modules: Dict[str, ModuleType] = {}
+    for variant in variants:
+        module = load_variant(variant)
+        if hasattr(module, 'marshal') and hasattr(module, 'unmarshal'):
+            modules[variant] = module
+        else:
+            results[variant] = {'error': 'not implemented'}
+    for name in corpora:
+        corpus = make_corpus(name, seed, scale)
+        for variant, module in modules.items():
+            try:
+                result = bench_variant(module, corpus, repeat)
+            except Exception as e:
+                result = {'error': f'{type(e).__name__}: {e}'}
+            results.setdefault(variant, {})[name] = result
+    return {
+        'meta': {
+            'commit': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'seed': seed,
+            'scale': scale,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def print_report(report: Dict[str, Any], baseline: Dict[str, Any] | None) -> None:
+    for variant, corpora in report['results'].items():
+        if 'error' in corpora:
+            print(f'{variant:>16}: {corpora["error"]}')
+            continue
+        for name, result in corpora.items():
+            if 'error' in result:
+                print(f'{variant:>16} {name:>15}: {result["error"]}')
+                continue
+            line = f'{variant:>16} {name:>15}:'
+            for op in ('marshal', 'unmarshal'):
+                m = result[op]
+                line += f'  {op} {m["mb_s"]:8.2f} MB/s {m["docs_s"]:10.1f} docs/s {m["peak_bytes"] / 2 ** 20:8.2f} MB'
+                old = (baseline or {}).get('results', {}).get(variant, {}).get(name, {}).get(op)
+                if old:
+                    line += f' (x{m["mb_s"] / old["mb_s"]:.2f})'
+            print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variants', default=','.join(VARIANTS))
+    parser.add_argument('--corpora', default=','.join(CORPORA))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='куда записать JSON-отчет')
+    parser.add_argument('--compare', help='JSON-отчет предыдущего запуска для сравнения')
+    args = parser.parse_args()
+
+    report = run(args.variants.split(','), args.corpora.split(','), args.seed, args.scale, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+# Загрузка разных реализаций bson: из каталога задачи или из git-ревизии
+
+import contextlib
+import importlib.util
+import io
+import subprocess
+from pathlib import Path
+from types import ModuleType
+
+TASKS_DIR = Path(__file__).resolve().parent.parent / 'tasks'
+VARIANTS = ['mvp', 'strict_out', 'strict_in', 'class_api', 'more_types', 'keep_types', 'dataclasses', 'keep_more_types']
+
+
+def load_variant(variant: str) -> ModuleType:
+    spec = importlib.util.spec_from_file_location(f'bson_{variant}', TASKS_DIR / variant / 'bson.py')
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    # mvp печатает отладочный вывод при импорте
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+    return module
+
+
+def load_revision(rev: str, variant: str = 'strict_out') -> ModuleType:
+    source = subprocess.run(
+        ['git', 'show', f'{rev}:./bson.py'], cwd=TASKS_DIR / variant, capture_output=True, text=True, check=True,
+    ).stdout
+    module = ModuleType(f'bson_{variant}_{rev}')
+    with contextlib.redirect_stdout(io.StringIO()):
+        exec(compile(source, f'{rev}:{variant}/bson.py', 'exec'), module.__dict__)
+    return module
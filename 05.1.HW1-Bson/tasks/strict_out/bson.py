@@ -1,9 +1,42 @@
 
 # your code
 
+import asyncio
+import bisect
+import codecs
+import contextlib
+import dataclasses
+import io
+import itertools
+import mmap
+import os
+import re
+import shutil
 import struct
-from datetime import datetime, timezone
-from typing import Dict, Any
+import sys
+import tempfile
+import threading
+import types
+import zlib
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from time import perf_counter_ns
+from typing import BinaryIO, Callable, Dict, Any, Iterable, Iterator, Sequence, overload
+
+# numpy необязателен: без него numpy-типы не кодируются, а to_columns недоступна
+np: Any
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
 
 
 #Классы исключений
@@ -44,6 +77,9 @@ class BsonDocumentTooBigError(BsonInputTooBigError):
 class BsonCycleDetectedError(BsonMarshalError):
     pass
 
+class BsonPatchTypedValueError(BsonMarshalError):
+    pass
+
 class BsonUnmarshalError(BsonError):
     pass
 
@@ -86,221 +122,2398 @@ class BsonInvalidBinarySubtypeError(BsonBrokenDataError):
 class BsonBadArrayIndexError(BsonBrokenDataError):
     pass
 
+class BsonSchemaMismatchError(BsonUnmarshalError):
+    pass
 
-def make_key(data: list[int], i: int) -> tuple[str, int]:
-    i += 1
-    list_for_key = []
-    while  i < len(data) and data[i] != 0:
-        list_for_key.append(data[i])
-        i += 1
+class BsonInvalidArrayError(BsonBrokenDataError):
+    pass
+
+class BsonInvalidMetadataError(BsonBrokenDataError):
+    pass
+
+class BsonDatetimeOutOfRangeError(BsonBrokenDataError):
+    pass
+
+class BsonDocumentSizeLimitError(BsonUnmarshalError):
+    pass
+
+
+# Источник байтов для декодера: нужны только индексация и find
+RawData = bytes | bytearray | mmap.mmap
+
+
+KEY_TABLE_LIMIT = 1 << 14
+
+
+class KeyTable:
+    # Общая таблица ключей декодера: сырые байты ключа -> один объект str на все документы.
+    # При переполнении таблица сбрасывается, так она переживает смену схемы и длинные массивы
+    def __init__(self, limit: int = KEY_TABLE_LIMIT) -> None:
+        self.limit = limit
+        self.keys: Dict[bytes, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, raw: bytes) -> str:
+        self.misses += 1
+        key = codecs.utf_8_decode(raw)[0]
+        if len(self.keys) >= self.limit:
+            self.keys.clear()
+        self.keys[raw] = key
+        return key
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self.keys), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self) -> None:
+        self.keys.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+KEY_TABLE = KeyTable()
+
+
+def make_key(data: RawData, view: memoryview, i: int) -> tuple[str, int]:
+    # i указывает на байт типа элемента, имя начинается сразу за ним
     i += 1
-    return bytes(list_for_key).decode(), i
+    end = data.find(b'\x00', i)
+    if end == -1:
+        raise BsonBrokenDataError
+    raw = data[i:end]
+    if not isinstance(raw, bytes):
+        # срез bytearray - снова bytearray, а ключ словаря должен быть неизменяемым
+        raw = bytes(raw)
+    key = KEY_TABLE.keys.get(raw)
+    if key is None:
+        key = KEY_TABLE.add(raw)
+    else:
+        KEY_TABLE.hits += 1
+    return key, end + 1
 
-def Binary(elem: bytes) -> bytes:
-    return Int32(elem[:-1]) + bytes([0]) + elem
+INT32_MAX = 2 ** 31 - 1
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+EPOCH = datetime(1970, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
+MILLISECOND = timedelta(milliseconds=1)
 
-def Int32(elem: Any) -> bytes:
-    if isinstance(elem, str):
-        elem = elem.encode()
-    return struct.pack('i', len(elem) + 1)
 
-def Document(e_list: bytes) -> bytes:
-    return struct.pack('i', len(e_list) + 5) + e_list + bytes([0])
+def Cstring(elem: str) -> bytes:
+    return elem.encode() + bytes([0])
 
-def E_list(data: Dict[Any, Any], data_for: Dict[Any, Any]) -> bytes:
-    e_list = b''
-    for key in data:
-        elem = data[key]
-        e_list += Element(key, elem, data_for)
-    return e_list
 
-def UnE_list(data: list[int], new_data: Dict[Any, Any]) -> None:
-    i = 0
-    value: Any = None
-    while i < len(data):
-        bt = data[i]
-        if bt == 2:
-            key, i = make_key(data, i)
-            #print(i)
-            let_amount = struct.unpack('i', bytes(data[i:i+4]))[0]
-            i += 4
-            list_for_value = []
-            while let_amount > 1:
-                list_for_value.append(data[i])
-                let_amount -= 1
-                i += 1
-            value = bytes(list_for_value).decode()
-            new_data[key] = value
-            i += 1
+# Закодированные имена элементов массива b'0\x00', b'1\x00', ...: таблица общая на процесс
+# и растет по мере надобности, до длины самого длинного встреченного массива, но не дальше
+# ARRAY_KEYS_LIMIT. Полная таблица занимает около 48 МиБ и остается в памяти процесса, зато
+# списки до миллиона элементов не форматируют имена на каждый marshal. Выросшая таблица
+# собирается заново и подменяет старую под блокировкой, так что уже выданный список не меняется
+ARRAY_KEYS_LIMIT = 1 << 20
+ARRAY_KEYS: list[bytes] = []
+ARRAY_KEYS_LOCK = threading.Lock()
 
 
-        elif bt == 1:
-            key, i = make_key(data, i)
-            list_for_value = []
-            for j in range(8):
-                list_for_value.append(data[i])
-                i += 1
-            value = struct.unpack('d', bytes(list_for_value))[0]
-            new_data[key] = value
+def index_names(start: int, stop: int) -> Sequence[bytes]:
+    # Имена для индексов start..stop-1; индексы за пределами таблицы кодируются на каждый массив
+    global ARRAY_KEYS
+    table = ARRAY_KEYS
+    if len(table) < min(stop, ARRAY_KEYS_LIMIT):
+        with ARRAY_KEYS_LOCK:
+            table = ARRAY_KEYS
+            if len(table) < min(stop, ARRAY_KEYS_LIMIT):
+                table = table + [b'%d\x00' % i for i in range(len(table), min(stop, ARRAY_KEYS_LIMIT))]
+                ARRAY_KEYS = table
+    if stop <= len(table):
+        return table if start == 0 else table[start:stop]
+    return table[start:] + [b'%d\x00' % i for i in range(max(start, len(table)), stop)]
 
-        elif bt == 8:
-            key, i = make_key(data, i)
-            if data[i] == 0:
-                value = False
-            else:
-                value = True
-            new_data[key] = value
-            i += 1
-        #binary data
-        elif bt == 5:
-            key, i = make_key(data, i)
-            num_of_bytes = struct.unpack('i', bytes(data[i:i+4]))[0]
-            i += 5
-            value = bytes(data[i:i+num_of_bytes])
-            i += num_of_bytes
-            new_data[key] = value
-
-        elif bt == 9:
-            key, i = make_key(data, i)
-            dt = data[i]
-            value = datetime(1970, 1, 1, 0, 0, 0, dt*1000, tzinfo=timezone.utc)
-            new_data[key] = value
-            i += 8
-
-        elif bt == 3:
-            key, i = make_key(data, i)
-            amount_of_bytes_in_doc = data[i]
-            value = unmarshal(bytes(data[i:i+amount_of_bytes_in_doc]))
-            i += amount_of_bytes_in_doc
-            new_data[key] = value
-
-        elif bt == 4:
-            key, i = make_key(data, i)
-            amount_of_bytes_in_doc = struct.unpack('i', bytes(data[i:i+4]))[0]
-            value = unmarshal(bytes(data[i:i+amount_of_bytes_in_doc]))
-            i += amount_of_bytes_in_doc
-            list_from_dict = []
-            for k in value:
-                list_from_dict.append(value[k])
-            new_data[key] = list_from_dict
-
-        elif bt == 16:
-            key, i = make_key(data, i)
-            value = struct.unpack('i', bytes(data[i : i + 4]))[0]
-            new_data[key] = value
-            i += 4
 
-        elif bt == 18:
-            key, i = make_key(data, i)
-            value = struct.unpack('q', bytes(data[i : i + 8]))[0]
-            new_data[key] = value
-            i += 8
+def write_string(buf: bytearray, elem: str) -> None:
+    encoded = elem.encode()
+    if len(encoded) + 1 > INT32_MAX:
+        raise BsonStringTooBigError
+    buf += struct.pack('<i', len(encoded) + 1)
+    buf += encoded
+    buf.append(0)
 
-        elif bt == 6:
-            key, i = make_key(data, i)
-            value = None
-            new_data[key] = value
-    return None
 
+def write_binary(buf: bytearray, elem: bytes | bytearray) -> None:
+    if len(elem) > INT32_MAX:
+        raise BsonBinaryTooBigError
+    buf += struct.pack('<iB', len(elem), 0)
+    buf += elem
 
-def Element(key: str, elem: Any, data_for: Dict[Any, Any]) -> bytes:
-    e_name = Cstring(key)
-    if isinstance(elem, str):
-        return bytes([2]) + e_name + String(elem)
-    elif isinstance(elem, float):
-        return bytes([1]) + e_name + struct.pack("d", elem)
-    elif isinstance(elem, bool):
-        return bytes([8]) + e_name + bytes([elem])
-    elif isinstance(elem, bytes):
-        return bytes([5]) + e_name + Binary(elem)
-    elif isinstance(elem, bytearray):
-        return bytes([5]) + e_name + Binary(elem)
-    elif isinstance(elem, datetime):
-        delta_time = int((elem.timestamp() - datetime(1970, 1, 1, 0, 0, 0, 0, tzinfo=timezone.utc).timestamp())*1000)
-        return bytes([9]) + e_name + bytes([delta_time]) + bytes([0, 0, 0, 0, 0, 0, 0])
-    elif isinstance(elem, dict):
-        try:
-            return bytes([3]) + e_name + marshal(elem)
-        except RecursionError:
-            raise BsonCycleDetectedError
 
-    elif isinstance(elem, list) or isinstance(elem, tuple):
-        new_data = dict()
+def end_document(buf: bytearray, start: int) -> None:
+    # Дописываем завершающий ноль и вписываем размер документа на зарезервированное место
+    buf.append(0)
+    size = len(buf) - start
+    if size > INT32_MAX:
+        raise BsonDocumentTooBigError
+    struct.pack_into('<i', buf, start, size)
+
+
+# Кодировщики элементов: по одному на тип значения, выбираются через Mapper.find_encoder
+# name - уже закодированное имя элемента (cstring с завершающим нулем).
+# Вложенные документы не кодируются рекурсивно, а открываются на стеке Writer
+Encoder = Callable[['Writer', bytearray, bytes, Any], None]
+
+
+def encode_string(writer: 'Writer', buf: bytearray, name: bytes, elem: str) -> None:
+    buf.append(2)
+    buf += name
+    write_string(buf, elem)
+
+
+def encode_float(writer: 'Writer', buf: bytearray, name: bytes, elem: float) -> None:
+    buf.append(1)
+    buf += name
+    buf += struct.pack('<d', elem)
+
+
+def encode_bool(writer: 'Writer', buf: bytearray, name: bytes, elem: bool) -> None:
+    buf.append(8)
+    buf += name
+    buf.append(elem)
+
+
+def encode_binary(writer: 'Writer', buf: bytearray, name: bytes, elem: bytes | bytearray) -> None:
+    buf.append(5)
+    buf += name
+    write_binary(buf, elem)
+
+
+def encode_datetime(writer: 'Writer', buf: bytearray, name: bytes, elem: datetime) -> None:
+    # Целочисленно: разность с эпохой делится нацело на миллисекунду (доли миллисекунды - вниз).
+    # Наивное время, как и в datetime.timestamp(), считается локальным
+    if elem.tzinfo is None:
+        elem = elem.astimezone(timezone.utc)
+    buf.append(9)
+    buf += name
+    buf += struct.pack('<q', (elem - EPOCH) // MILLISECOND)
+
+
+def encode_document(writer: 'Writer', buf: bytearray, name: bytes, elem: Dict[Any, Any]) -> None:
+    buf.append(3)
+    buf += name
+    writer.open_document(elem)
+
+
+def encode_array(writer: 'Writer', buf: bytearray, name: bytes, elem: list[Any] | tuple[Any, ...]) -> None:
+    buf.append(4)
+    buf += name
+    writer.open_array(elem)
+
+
+def encode_generator(writer: 'Writer', buf: bytearray, name: bytes, elem: Iterator[Any]) -> None:
+    # Генератор пишется как массив, элементы забираются из него пачками
+    buf.append(4)
+    buf += name
+    writer.open_iterator(elem)
+
+
+# Числовые массивы одного типа: тип элемента BSON -> (typecode array.array, dtype numpy, размер значения).
+# datetime (миллисекунды от эпохи) в array.array не кладется, только в numpy.datetime64[ms]
+NUMERIC_ARRAY_TYPES: Dict[int, tuple[str | None, str, int]] = {
+    1: ('d', '<f8', 8), 9: (None, '<M8[ms]', 8), 16: ('i', '<i4', 4), 18: ('q', '<i8', 8),
+}
+ARRAY_TYPECODES = {'d': 1, 'i': 16, 'q': 18}
+NUMPY_DTYPES = {'<f8': 1, '<M8[ms]': 9, '<i4': 16, '<i8': 18}
+
+
+def index_groups(n: int) -> Iterator[tuple[int, int, int]]:
+    # Индексы 0..n-1 группами одинаковой длины записи: (начало, конец, число цифр)
+    lo, digits = 0, 1
+    while lo < n:
+        hi = min(n, 10 ** digits)
+        yield lo, hi, digits
+        lo, digits = hi, digits + 1
+
+
+def index_prefixes(lo: int, hi: int, digits: int, bt: int) -> Any:
+    # Начала записей элементов lo..hi-1 одной длины: байт типа, цифры индекса, завершающий ноль
+    idx = np.arange(lo, hi)
+    prefixes = np.empty((hi - lo, digits + 2), np.uint8)
+    prefixes[:, 0] = bt
+    for j in range(digits):
+        prefixes[:, digits - j] = idx // 10 ** j % 10 + 48
+    prefixes[:, digits + 1] = 0
+    return prefixes
+
+
+def write_numeric_body(buf: bytearray, bt: int, elem: Any) -> None:
+    # Элементы массива пишутся целыми группами записей одной длины, без кодировщика на каждый элемент
+    typecode, dtype, size = NUMERIC_ARRAY_TYPES[bt]
+    if np is not None:
+        values = np.frombuffer(elem, dtype) if isinstance(elem, array) else np.ascontiguousarray(elem, dtype)
+        raw = values.view(np.uint8).reshape(len(values), size)
+        for lo, hi, digits in index_groups(len(values)):
+            records = np.empty((hi - lo, digits + 2 + size), np.uint8)
+            records[:, :digits + 2] = index_prefixes(lo, hi, digits, bt)
+            records[:, digits + 2:] = raw[lo:hi]
+            buf += records.data
+        return
+    assert typecode is not None
+    if sys.byteorder != 'little':
+        elem = array(typecode, elem)
+        elem.byteswap()
+    names = index_names(0, len(elem))
+    with memoryview(elem).cast('B') as raw:
         for i in range(len(elem)):
-            new_data[str(i)] = elem[i]
+            buf.append(bt)
+            buf += names[i]
+            buf += raw[i * size:i * size + size]
+
 
+def encode_numeric_array(writer: 'Writer', buf: bytearray, name: bytes, elem: Any) -> None:
+    # array.array('d'|'i'|'q') и одномерные массивы numpy; остальное кодируется как обычный список
+    if isinstance(elem, array):
+        bt = ARRAY_TYPECODES.get(elem.typecode)
+    else:
+        if elem.ndim != 1:
+            # 0-мерный массив - это скаляр; многомерный пишется как массив строк, каждая - снова ndarray
+            if elem.ndim == 0:
+                raise BsonUnsupportedObjectError
+            encode_array(writer, buf, name, list(elem))
+            return
+        if elem.dtype.kind == 'M':
+            # datetime64 в любых единицах пишется как datetime BSON, то есть в миллисекундах
+            elem = elem.astype('<M8[ms]')
+        bt = NUMPY_DTYPES.get(elem.dtype.newbyteorder('<').str)
+    if bt is None:
+        encode_array(writer, buf, name, elem.tolist())
+        return
+    buf.append(4)
+    buf += name
+    start = len(buf)
+    buf += bytes(4)
+    write_numeric_body(buf, bt, elem)
+    end_document(buf, start)
+
+
+def encode_int(writer: 'Writer', buf: bytearray, name: bytes, elem: int) -> None:
+    if -2147483648 <= elem <= 2147483647:
+        buf.append(16)
+        buf += name
+        buf += struct.pack('<i', elem)
+    elif INT64_MIN <= elem <= INT64_MAX:
+        buf.append(18)
+        buf += name
+        buf += struct.pack('<q', elem)
+    else:
+        raise BsonIntegerTooBigError
+
+
+def encode_none(writer: 'Writer', buf: bytearray, name: bytes, elem: None) -> None:
+    buf.append(6)
+    buf += name
+
+
+ENCODERS: Dict[type, Encoder] = {
+    str: encode_string,
+    float: encode_float,
+    bool: encode_bool,
+    bytes: encode_binary,
+    bytearray: encode_binary,
+    datetime: encode_datetime,
+    dict: encode_document,
+    list: encode_array,
+    tuple: encode_array,
+    array: encode_numeric_array,
+    int: encode_int,
+    type(None): encode_none,
+}
+if np is not None:
+    ENCODERS[np.ndarray] = encode_numeric_array
+
+
+# keep_types: служебное поле документа и разметка типов значений
+METADATA_KEY = '__metadata__'
+METADATA_NAME = Cstring(METADATA_KEY)
+METADATA_SUBTYPE = 128
+ANNOTATION_NAMES: Dict[Any, str] = {str: 'str', int: 'int', bool: 'bool', 'str': 'str', 'int': 'int', 'bool': 'bool'}
+ANNOTATION_TYPES: Dict[str, Any] = {'str': str, 'int': int, 'bool': bool}
+DATACLASS_PARAMS = ('init', 'repr', 'eq', 'order', 'unsafe_hash', 'frozen')
+
+
+def annotation_name(tp: Any) -> str:
+    # Аннотация бывает и нехешируемой, например Annotated[int, {'unit': 'ms'}]
+    try:
+        return ANNOTATION_NAMES.get(tp, 'any')
+    except TypeError:
+        return 'any'
+
+
+class ClassSchema:
+    # Схема именованного кортежа или датакласса: строится один раз на класс и кэшируется в Mapper,
+    # поэтому при сериализации экземпляров не нужно заново разбирать _fields и __dataclass_fields__.
+    # Описание класса для словаря типов keep_types строится при первом обращении - без keep_types оно не нужно
+    def __init__(self, cls: type, fields: list[str]) -> None:
+        self.cls = cls
+        self.fields = tuple(fields)
+        self.names = [Cstring(field) for field in fields]
+        self.is_tuple = issubclass(cls, tuple)
+        self.kind = 'nt' if self.is_tuple else 'dc'
+        self._description: Dict[str, Any] | None = None
+
+    @property
+    def description(self) -> Dict[str, Any]:
+        if self._description is None:
+            cls = self.cls
+            if self.is_tuple:
+                self._description = {'name': cls.__name__, 'fields': list(self.fields),
+                                     'defaults': dict(getattr(cls, '_field_defaults', {}))}
+            else:
+                params = cls.__dataclass_params__  # type: ignore[attr-defined]
+                # Словарь аннотаций сериализуется с отсортированными ключами, порядок полей - в fields
+                self._description = {
+                    'name': cls.__name__,
+                    'fields': list(self.fields),
+                    'annotations': {field.name: annotation_name(field.type) for field in dataclasses.fields(cls)},
+                    'params': {param: getattr(params, param) for param in DATACLASS_PARAMS},
+                }
+        return self._description
+
+    def values(self, elem: Any) -> Sequence[Any]:
+        if self.is_tuple:
+            return elem
+        return [getattr(elem, field) for field in self.fields]
+
+    def __call__(self, writer: 'Writer', buf: bytearray, name: bytes, elem: Any) -> None:
+        buf.append(3)
+        buf += name
+        if writer.keep_types:
+            writer.type_id(self)
+        writer.open_items(elem, self.names, self.values(elem))
+
+
+def UnElement(data: RawData, view: memoryview, bt: int, i: int, arrays: str | None = None,
+              keep: 'TypeRestorer | None' = None, python_only: bool = False) -> tuple[Any, int]:
+    value: Any = None
+    if bt == 2:
+        let_amount = struct.unpack_from('<i', view, i)[0]
+        # Размеры не проверены заранее: отрицательный увел бы разбор назад, и он бы зациклился
+        if let_amount < 1:
+            raise BsonStringSizeError
+        i += 4
+        value = codecs.utf_8_decode(view[i:i + let_amount - 1])[0]
+        i += let_amount
+
+    elif bt == 1:
+        value = struct.unpack_from('<d', view, i)[0]
+        i += 8
+
+    elif bt == 8:
+        value = data[i] != 0
+        i += 1
+    #binary data
+    elif bt == 5:
+        num_of_bytes = struct.unpack_from('<i', view, i)[0]
+        if num_of_bytes < 0:
+            raise BsonBrokenDataError
+        if python_only and data[i + 4] != 0:
+            raise BsonInvalidBinarySubtypeError
+        i += 5
+        value = bytes(view[i:i + num_of_bytes])
+        i += num_of_bytes
+
+    elif bt == 9:
         try:
-            return bytes([4]) + e_name + marshal(new_data)
-        except RecursionError:
-            raise BsonCycleDetectedError
+            value = EPOCH + MILLISECOND * struct.unpack_from('<q', view, i)[0]
+        except OverflowError:
+            # int64 миллисекунд шире диапазона datetime (годы 1..9999)
+            raise BsonDatetimeOutOfRangeError from None
+        i += 8
+
+    elif bt == 3:
+        amount_of_bytes_in_doc = struct.unpack_from('<i', view, i)[0]
+        if amount_of_bytes_in_doc < 5:
+            raise BsonIncorrectSizeError
+        value = {}
+        UnE_list(data, view, i + 4, i + amount_of_bytes_in_doc - 1, value, arrays, keep, UnElement, python_only)
+        i += amount_of_bytes_in_doc
+
+    elif bt == 4:
+        amount_of_bytes_in_doc = struct.unpack_from('<i', view, i)[0]
+        if amount_of_bytes_in_doc < 5:
+            raise BsonIncorrectSizeError
+        if arrays is not None:
+            value = UnNumericArray(data, view, i + 4, i + amount_of_bytes_in_doc - 1, arrays)
+        if value is None:
+            value = []
+            UnE_array(data, view, i + 4, i + amount_of_bytes_in_doc - 1, value, arrays, keep, UnElement,
+                      python_only)
+        i += amount_of_bytes_in_doc
+
+    elif bt == 16:
+        value = struct.unpack_from('<i', view, i)[0]
+        i += 4
+
+    elif bt == 18:
+        value = struct.unpack_from('<q', view, i)[0]
+        i += 8
+
+    elif bt == 6:
+        value = None
 
-    elif isinstance(elem, int):
-        if -2147483648 <= elem <= 2147483647:
-            return bytes([16]) + e_name + struct.pack('i', elem)
-        else:
-            return bytes([18]) + e_name + struct.pack('q', elem)
-    elif elem is None:
-        return bytes([6]) + e_name
     else:
-        raise BsonUnsupportedObjectError
+        raise BsonInvalidElementTypeError
+    return value, i
 
 
-def String(elem: str) -> bytes:
-    return Int32(elem) + elem.encode() + bytes([0])
+# Декодер значения элемента: UnElement или ProfiledDecoder (Mapper(profile=True))
+ElementDecoder = Callable[..., tuple[Any, int]]
 
 
-def Cstring(elem: str) -> bytes:
-    return elem.encode() + bytes([0])
+def UnE_list(data: RawData, view: memoryview, i: int, end: int, new_data: Dict[Any, Any],
+             arrays: str | None = None, keep: 'TypeRestorer | None' = None,
+             element: ElementDecoder = UnElement, python_only: bool = False) -> None:
+    # Разбираем элементы документа с позиции i до завершающего нуля в позиции end.
+    # Метаданные keep_types в документ не попадают: без keep они просто пропускаются
+    metadata = None
+    while i < end:
+        bt = data[i]
+        key, i = make_key(data, view, i)
+        if bt == 5 and key == METADATA_KEY and data[i + 4] == METADATA_SUBTYPE:
+            size = struct.unpack_from('<i', view, i)[0]
+            if size < 0:
+                raise BsonBrokenDataError
+            metadata = bytes(view[i + 5:i + 5 + size])
+            i += 5 + size
+            continue
+        new_data[key], i = element(data, view, bt, i, arrays, keep, python_only)
+    if metadata is not None and keep is not None:
+        keep.add(new_data, metadata)
+    return None
 
 
-def marshal(data: Dict[Any, Any]) -> bytes:
+def UnE_array(data: RawData, view: memoryview, i: int, end: int, values: list[Any],
+              arrays: str | None = None, keep: 'TypeRestorer | None' = None,
+              element: ElementDecoder = UnElement, python_only: bool = False) -> None:
+    # Элементы массива: ключи-индексы не декодируются, а сравниваются с ожидаемыми b'0\x00', b'1\x00', ...
+    # Индекс не по порядку разбирается отдельно: "дырки" заполняются None (в python_only это ошибка),
+    # а меньший индекс допустим только на месте такой дырки
+    append = values.append
+    names: Sequence[bytes] = ARRAY_KEYS
+    metadata = None
+    holes: set[int] | None = None
+    first = i
+    while i < end:
+        bt = data[i]
+        start = i + 1
+        n = len(values)
+        if n >= len(names):
+            names = index_names(0, 2 * n + 16)
+        name = names[n]
+        i = start + len(name)
+        if data[start:i] == name:
+            value, i = element(data, view, bt, i, arrays, keep, python_only)
+            append(value)
+            continue
+        i = data.find(b'\x00', start) + 1
+        if i == 0:
+            raise BsonBrokenDataError
+        if bt == 5 and i - start == len(METADATA_NAME) and data[i + 4] == METADATA_SUBTYPE \
+                and data[start:i] == METADATA_NAME:
+            size = struct.unpack_from('<i', view, i)[0]
+            if size < 0:
+                raise BsonBrokenDataError
+            metadata = bytes(view[i + 5:i + 5 + size])
+            i += 5 + size
+            continue
+        if ARRAY_INDEX.fullmatch(data, start, i - 1) is None:
+            raise BsonBadArrayIndexError
+        k = int(data[start:i - 1])
+        if python_only:
+            raise BsonRepeatedKeyDataError if k < n else BsonInvalidArrayError
+        # Дырка не может быть длиннее самого массива: иначе пара байтов раздула бы список до гигабайтов
+        if k - n > end - first:
+            raise BsonInvalidArrayError
+        value, i = element(data, view, bt, i, arrays, keep, python_only)
+        if k >= n:
+            if holes is None:
+                holes = set()
+            holes.update(range(n, k))
+            values.extend([None] * (k - n))
+            append(value)
+        elif holes is not None and k in holes:
+            holes.discard(k)
+            values[k] = value
+        else:
+            raise BsonRepeatedKeyDataError
+    if metadata is not None and keep is not None:
+        keep.add(values, metadata)
+
+
+TYPE_REGISTRY_LIMIT = 1 << 12
+METADATA_CACHE_LIMIT = 1 << 10
+
+
+def freeze(value: Any) -> Any:
+    # Неизменяемый слепок декодированного значения - для ключа реестра типов
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, bytearray):
+        return bytes(value)
+    return value
+
+
+class TypeRegistry:
+    # Классы, восстановленные из словаря типов keep_types. Ключ - структурный отпечаток описания
+    # (имя, поля, значения по умолчанию, аннотации, параметры), поэтому один и тот же класс
+    # переиспользуется всеми документами и вызовами, а не создается заново на каждый документ
+    def __init__(self, limit: int = TYPE_REGISTRY_LIMIT) -> None:
+        self.limit = limit
+        self.classes: Dict[tuple[Any, ...], type] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def restore(self, kind: str, description: Any) -> type:
+        if not isinstance(description, dict):
+            raise BsonInvalidMetadataError
+        name = description.get('name')
+        if not isinstance(name, str):
+            raise BsonInvalidMetadataError
+        fingerprint: tuple[Any, ...]
+        try:
+            if kind == 'nt':
+                fields = description['fields']
+                defaults = description.get('defaults', {})
+                fingerprint = ('nt', name, freeze(fields), freeze(defaults))
+            elif kind == 'dc':
+                fields = description.get('fields', list(description['annotations']))
+                annotations = description['annotations']
+                params = description.get('params', {})
+                # Параметры приходят из данных: в make_dataclass пропускаем только известные флаги
+                if not isinstance(params, dict) or any(
+                        param not in DATACLASS_PARAMS or type(flag) is not bool for param, flag in params.items()):
+                    raise BsonInvalidMetadataError
+                fingerprint = ('dc', name, freeze(fields), freeze(annotations), freeze(params))
+            else:
+                raise BsonInvalidMetadataError
+            cached = self.classes.get(fingerprint)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+            cls: type = (
+                namedtuple(name, fields, defaults=[defaults[field] for field in fields if field in defaults])
+                if kind == 'nt' else
+                dataclasses.make_dataclass(
+                    name, [(field, ANNOTATION_TYPES.get(annotations[field], Any)) for field in fields], **params)
+            )
+        except BsonError:
+            raise
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise BsonInvalidMetadataError from e
+        if len(self.classes) >= self.limit:
+            self.classes.clear()
+        self.classes[fingerprint] = cls
+        return cls
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self.classes), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self) -> None:
+        self.classes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+TYPE_REGISTRY = TypeRegistry()
+# Разобранные метаданные по их сырым байтам: (маркеры, словарь типов, тип корня)
+Metadata = tuple[tuple[str, ...], Dict[str, type], str | None]
+METADATA_CACHE: Dict[bytes, Metadata] = {}
+
+
+def parse_metadata(raw: bytes) -> Metadata:
+    # Простая форма - маркеры через двоеточие; в корне после нулевого байта - сериализованный словарь
+    # с ключами types, children и, если корень сам именованный кортеж или датакласс, self
+    entry = METADATA_CACHE.get(raw)
+    if entry is not None:
+        return entry
+    types: Dict[str, type] = {}
+    root = None
+    if raw[:1] == b'\x00':
+        validate(raw[1:], python_only=True)
+        meta = DEFAULT_MAPPER.unmarshal(raw[1:])
+        text, root = meta.get('children', ''), meta.get('self')
+        if not isinstance(meta.get('types', {}), dict) or not isinstance(text, str) \
+                or not (root is None or isinstance(root, str)):
+            raise BsonInvalidMetadataError
+        for type_id, description in meta.get('types', {}).items():
+            types[type_id] = TYPE_REGISTRY.restore(type_id.partition('-')[0], description)
+    else:
+        try:
+            text = raw.decode()
+        except UnicodeDecodeError as e:
+            raise BsonInvalidMetadataError from e
+    entry = (tuple(text.split(':')) if text else (), types, root)
+    if len(METADATA_CACHE) >= METADATA_CACHE_LIMIT:
+        METADATA_CACHE.clear()
+    METADATA_CACHE[raw] = entry
+    return entry
+
+
+class TypeRestorer:
+    # Состояние keep_types на один вызов unmarshal. Документы с метаданными копятся в порядке
+    # закрытия, вложенные раньше объемлющих, а типы восстанавливаются в конце: словарь типов
+    # лежит в корне, то есть разбирается последним
+    def __init__(self) -> None:
+        self.pending: list[tuple[Any, tuple[str, ...]]] = []
+        self.types: Dict[str, type] = {}
+        self.root: str | None = None
+
+    def add(self, container: Any, raw: bytes) -> None:
+        markers, types, root = parse_metadata(raw)
+        if types:
+            self.types.update(types)
+        if root is not None:
+            self.root = root
+        if markers:
+            self.pending.append((container, markers))
+
+    def convert(self, marker: str, value: Any) -> Any:
+        if marker == 'tuple':
+            if type(value) is list:
+                return tuple(value)
+            # Числовой массив уже разобран в array.array или numpy по опции arrays
+            if type(value) is array or (np is not None and type(value) is np.ndarray):
+                return value
+        elif marker == 'bytearray':
+            if type(value) is bytes:
+                return bytearray(value)
+        else:
+            cls = self.types.get(marker)
+            if cls is not None and type(value) is dict:
+                if issubclass(cls, tuple):
+                    try:
+                        return cls(**value)
+                    except TypeError as e:
+                        raise BsonInvalidMetadataError from e
+                if value.keys() != cls.__dataclass_fields__.keys():  # type: ignore[attr-defined]
+                    raise BsonInvalidMetadataError
+                # Без __init__: у датакласса может быть init=False или frozen=True
+                obj = object.__new__(cls)
+                for key, item in value.items():
+                    object.__setattr__(obj, key, item)
+                return obj
+        raise BsonInvalidMetadataError
+
+    def finish(self, doc: Dict[Any, Any]) -> Any:
+        convert = self.convert
+        for container, markers in self.pending:
+            keys = range(len(container)) if type(container) is list else list(container)
+            if len(keys) != len(markers):
+                raise BsonInvalidMetadataError
+            for key, marker in zip(keys, markers):
+                if marker:
+                    container[key] = convert(marker, container[key])
+        if self.root is not None:
+            return convert(self.root, doc)
+        return doc
+
+
+def numeric_array_length(size: int, item: int) -> int:
+    # Сколько элементов по item байт с индексами подряд занимают ровно size байт; -1 - ни сколько
+    n = 0
+    for lo, hi, digits in index_groups(size):
+        record = digits + 2 + item
+        count = min(hi - lo, size // record)
+        size -= count * record
+        n += count
+        if count < hi - lo:
+            break
+    return n if size == 0 else -1
+
+
+def UnNumericArray(data: RawData, view: memoryview, i: int, end: int, arrays: str) -> Any:
+    # Массив из элементов одного числового типа с индексами 0, 1, ... подряд - в array.array или numpy.
+    # None - массив не такой, его разбирает UnE_array
+    if i >= end or data[i] not in NUMERIC_ARRAY_TYPES:
+        return None
+    bt = data[i]
+    typecode, dtype, size = NUMERIC_ARRAY_TYPES[bt]
+    if typecode is None and arrays != 'numpy':
+        return None
+    n = numeric_array_length(end - i, size)
+    if n < 0:
+        return None
+    if arrays == 'numpy':
+        # datetime раскладывается прямо в datetime64[ms]: те же 8 байт little-endian
+        result = np.empty(n, dtype)
+        out = result.view(np.uint8).reshape(n, size)
+        for lo, hi, digits in index_groups(n):
+            records = np.frombuffer(data, np.uint8, (hi - lo) * (digits + 2 + size), i).reshape(hi - lo, -1)
+            if not np.array_equal(records[:, :digits + 2], index_prefixes(lo, hi, digits, bt)):
+                return None
+            out[lo:hi] = records[:, digits + 2:]
+            i += records.size
+        return result
+    assert typecode is not None
+    values = array(typecode)
+    unpack = struct.Struct('<' + typecode).unpack_from
+    names = index_names(0, n)
+    for k in range(n):
+        name = names[k]
+        if data[i] != bt or data[i + 1:i + 1 + len(name)] != name:
+            return None
+        i += 1 + len(name)
+        values.append(unpack(view, i)[0])
+        i += size
+    return values
+
+
+def skip_element(data: RawData, view: memoryview, bt: int, i: int) -> int:
+    # Смещение следующего элемента без декодирования значения. Размеры из данных проверяются:
+    # отрицательный размер вернул бы смещение назад, и обход документа никогда бы не закончился
+    if bt in (1, 9, 18):
+        return i + 8
+    elif bt == 16:
+        return i + 4
+    elif bt == 8:
+        return i + 1
+    elif bt == 6:
+        return i
+    elif bt == 2:
+        size = struct.unpack_from('<i', view, i)[0]
+        if size < 1:
+            raise BsonStringSizeError
+        return i + 4 + size
+    elif bt == 5:
+        size = struct.unpack_from('<i', view, i)[0]
+        if size < 0:
+            raise BsonBrokenDataError
+        return i + 5 + size
+    elif bt in (3, 4):
+        size = struct.unpack_from('<i', view, i)[0]
+        if size < 5:
+            raise BsonIncorrectSizeError
+        return i + size
+    raise BsonInvalidElementTypeError
+
+
+# Дерево проекции: ключ -> None (значение целиком) или поддерево для вложенного документа/массива
+Projection = Dict[str, Any]
+
+
+def make_projection(fields: Iterable[str]) -> Projection:
+    projection: Projection = {}
+    for path in fields:
+        *parents, last = path.split('.')
+        node: Projection | None = projection
+        for part in parents:
+            assert node is not None
+            if part in node and node[part] is None:
+                # Родитель уже запрошен целиком
+                node = None
+                break
+            node = node.setdefault(part, {})
+        if node is not None:
+            node[last] = None
+    return projection
+
+
+def projected_list(items: Dict[str, Any]) -> list[Any]:
+    # Пропущенные элементы массива заменяются на None, чтобы выбранные остались на своих позициях
+    result: list[Any] = []
+    for key, value in items.items():
+        if not (key.isascii() and key.isdigit()):
+            raise BsonBadArrayIndexError
+        index = int(key)
+        if index >= len(result):
+            result.extend([None] * (index + 1 - len(result)))
+        result[index] = value
+    return result
+
+
+def UnE_list_projected(data: RawData, view: memoryview, i: int, end: int, new_data: Dict[Any, Any],
+                       projection: Projection, arrays: str | None = None, python_only: bool = False) -> None:
+    # Как UnE_list, но непрошенные элементы перепрыгиваются по их размеру, не декодируясь.
+    # Вложенный документ или массив попадает в результат, только если в нем нашелся хотя бы один
+    # запрошенный путь; путь глубже скалярного значения означает, что такого поля нет
+    while i < end:
+        bt = data[i]
+        key, i = make_key(data, view, i)
+        sub = projection.get(key, False)
+        # Проекция собирает только обычные словари и списки: метаданные keep_types к ней не применяются
+        if bt == 5 and key == METADATA_KEY and i + 4 < end and data[i + 4] == METADATA_SUBTYPE:
+            sub = False
+        if sub is None:
+            new_data[key], i = UnElement(data, view, bt, i, arrays, None, python_only)
+            continue
+        nxt = skip_element(data, view, bt, i)
+        if nxt > end:
+            raise BsonBrokenDataError
+        if sub is not False and (bt == 3 or bt == 4):
+            value: Dict[str, Any] = {}
+            UnE_list_projected(data, view, i + 4, nxt - 1, value, sub, arrays, python_only)
+            if value:
+                new_data[key] = value if bt == 3 else projected_list(value)
+        i = nxt
+
+
+class LazyDocument(Mapping[str, Any]):
+    # Документ поверх исходных байтов: индекс ключей строится при первом обращении,
+    # значения декодируются только при чтении соответствующего ключа
+    def __init__(self, data: bytes | bytearray | memoryview, start: int = 0) -> None:
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        self._data = data
+        self._start = start
+        self._index: Dict[str, tuple[int, int]] | None = None
+        self._values: Dict[str, Any] = {}
+
+    def _get_index(self) -> Dict[str, tuple[int, int]]:
+        if self._index is None:
+            data = self._data
+            index: Dict[str, tuple[int, int]] = {}
+            with memoryview(data) as view:
+                i = self._start + 4
+                end = self._start + struct.unpack_from('<i', view, self._start)[0] - 1
+                if end >= len(data) or data[end] != 0:
+                    raise BsonBrokenDataError
+                while i < end:
+                    bt = data[i]
+                    key, i = make_key(data, view, i)
+                    start = i
+                    # Размеры не проверены заранее: элемент не должен выходить за документ
+                    i = skip_element(data, view, bt, i)
+                    if i > end:
+                        raise BsonBrokenDataError
+                    # Маппера здесь нет, поэтому, как и unmarshal без keep_types, метаданные пропускаем
+                    if bt == 5 and key == METADATA_KEY and data[start + 4] == METADATA_SUBTYPE:
+                        continue
+                    index[key] = (bt, start)
+            self._index = index
+        return self._index
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._values:
+            return self._values[key]
+        bt, i = self._get_index()[key]
+        if bt == 3:
+            value: Any = LazyDocument(self._data, i)
+        else:
+            with memoryview(self._data) as view:
+                value = UnElement(self._data, view, bt, i)[0]
+        self._values[key] = value
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._get_index())
+
+    def __len__(self) -> int:
+        return len(self._get_index())
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._get_index()
+
+    def __repr__(self) -> str:
+        return f'LazyDocument({list(self._get_index())})'
+
+
+def element_marker(buf: RawData, view: memoryview, i: int, end: int, target: int) -> str:
+    # Маркер keep_types элемента, начинающегося в target, из метаданных документа с элементами [i, end).
+    # Маркеры идут по порядку элементов без учета самого __metadata__
+    position, metadata = 0, None
+    while i < end:
+        bt = buf[i]
+        k = buf.find(b'\x00', i + 1, end)
+        if k == -1:
+            raise BsonBrokenDataError
+        nxt = skip_element(buf, view, bt, k + 1)
+        if nxt <= k or nxt > end:
+            raise BsonBrokenDataError
+        if bt == 5 and buf[k + 5] == METADATA_SUBTYPE and buf[i + 1:k + 1] == METADATA_NAME:
+            metadata = bytes(view[k + 6:nxt])
+        elif i < target:
+            position += 1
+        i = nxt
+    if metadata is None:
+        return ''
+    markers = parse_metadata(metadata)[0]
+    return markers[position] if position < len(markers) else ''
+
+
+@overload
+def patch(buf: bytearray, path: str | Sequence[str | int], value: Any) -> bytearray: ...
+
+
+@overload
+def patch(buf: bytes, path: str | Sequence[str | int], value: Any) -> bytes: ...
+
+
+def patch(buf: bytes | bytearray, path: str | Sequence[str | int], value: Any) -> bytes | bytearray:
+    # Замена значения по пути вида "user.address.city" (или списку ключей) без перекодирования документа:
+    # элемент находится прыжками по размерам, новый вклеивается на его место, а правятся только размеры
+    # объемлющих документов. bytearray меняется на месте и возвращается он же, для bytes - новый объект
+    parts = path.split('.') if isinstance(path, str) else [str(part) for part in path]
+    if len(buf) < 4:
+        raise BsonBrokenDataError
+    size = struct.unpack_from('<i', buf, 0)[0]
+    if size < 5:
+        raise BsonIncorrectSizeError
+    if size < len(buf):
+        raise BsonTooManyDataError
+    if size > len(buf):
+        raise BsonNotEnoughDataError
+
+    # starts - позиции размеров документов на пути, от корня; [i, nxt) - заменяемый элемент
+    starts: list[int] = []
+    start, i, nxt = 0, 4, 0
+    with memoryview(buf) as view:
+        for depth, part in enumerate(parts):
+            end = start + struct.unpack_from('<i', view, start)[0] - 1
+            if end >= len(buf) or buf[end] != 0:
+                raise BsonBrokenDataError
+            name = Cstring(part)
+            while True:
+                if i >= end:
+                    raise KeyError('.'.join(parts[:depth + 1]))
+                bt = buf[i]
+                k = buf.find(b'\x00', i + 1, end)
+                if k == -1:
+                    raise BsonBrokenDataError
+                nxt = skip_element(buf, view, bt, k + 1)
+                if nxt <= k or nxt > end:
+                    raise BsonBrokenDataError
+                if k == i + len(name) and buf.startswith(name, i + 1):
+                    break
+                i = nxt
+            starts.append(start)
+            if depth + 1 < len(parts):
+                if bt != 3 and bt != 4:
+                    raise KeyError('.'.join(parts[:depth + 2]))
+                start, i = k + 1, k + 5
+        # Значение, восстанавливаемое keep_types (кортеж, датакласс...), описано маркером в метаданных родителя:
+        # после замены маркер стал бы относиться к чужому значению и ломал бы разбор
+        if buf.find(METADATA_NAME, start + 4, end) != -1 and element_marker(buf, view, start + 4, end, i):
+            raise BsonPatchTypedValueError('.'.join(parts))
+
+    element = DEFAULT_MAPPER.marshal({parts[-1]: value})[4:-1]
+    delta = len(element) - (nxt - i)
+    # Новые размеры считаем до изменения буфера: слишком большой документ не должен остаться полуисправленным
+    sizes = [struct.unpack_from('<i', buf, start)[0] + delta for start in starts]
+    if delta and max(sizes) > INT32_MAX:
+        raise BsonDocumentTooBigError
+    out = buf if isinstance(buf, bytearray) else bytearray(buf)
+    out[i:nxt] = element
+    if delta:
+        for start, size in zip(starts, sizes):
+            struct.pack_into('<i', out, start, size)
+    return out if out is buf else bytes(out)
+
+
+# Кэш форм ограничен и числом форм, и суммарным числом ключей в них: широкие словари тоже
+# кэшируются, но вытесняют старые формы, а не раздувают кэш. Форма шире всего SHAPE_CACHE_KEYS
+# не кэшируется вовсе - такой словарь обычно разовый
+SHAPE_CACHE_LIMIT = 1024
+SHAPE_CACHE_KEYS = 1 << 16
+# Маркеры keep_types запоминаются только для документов и массивов не длиннее MARKERS_SHAPE_LIMIT
+MARKERS_CACHE_LIMIT = 1024
+MARKERS_SHAPE_LIMIT = 64
+
+
+class ShapeCache:
+    # LRU: кортеж ключей словаря в исходном порядке -> ключи в порядке записи и их закодированные имена.
+    # Словари одной формы не сортируются и не кодируют ключи заново; в кэш попадают только формы,
+    # прошедшие проверки ключей
+    def __init__(self, limit: int = SHAPE_CACHE_LIMIT, keys_limit: int = SHAPE_CACHE_KEYS) -> None:
+        self.limit = limit
+        self.keys_limit = keys_limit
+        self.keys = 0
+        self.entries: OrderedDict[tuple[Any, ...], tuple[list[str], list[bytes]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, shape: tuple[Any, ...]) -> tuple[list[str], list[bytes]] | None:
+        entry = self.entries.get(shape)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(shape)
+        return entry
+
+    def add(self, shape: tuple[Any, ...], keys: list[str]) -> tuple[list[str], list[bytes]]:
+        entry = (keys, [Cstring(key) for key in keys])
+        if len(keys) <= self.keys_limit:
+            old = self.entries.pop(shape, None)
+            if old is not None:
+                self.keys -= len(old[0])
+            self.entries[shape] = entry
+            self.keys += len(keys)
+            while len(self.entries) > self.limit or self.keys > self.keys_limit:
+                self.keys -= len(self.entries.popitem(last=False)[1][0])
+        return entry
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {'size': len(self.entries), 'keys': self.keys, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.keys = 0
+        self.hits = 0
+        self.misses = 0
+
+
+class CodecProfile:
+    # Счетчики Mapper(profile=True). По типу элемента BSON: число элементов, байты значений и время в нс.
+    # Время собственное: у документов и массивов без вложенных элементов, а байты у них - только
+    # размер и завершающий ноль (массив, записанный или разобранный целиком, - весь). Глубина - уровень
+    # вложенности элемента, у элементов корня 1
+    def __init__(self) -> None:
+        self.encode: Dict[int, list[int]] = {}
+        self.decode: Dict[int, list[int]] = {}
+        self.encode_depth: Dict[int, int] = {}
+        self.decode_depth: Dict[int, int] = {}
+
+    @staticmethod
+    def add(table: Dict[int, list[int]], depths: Dict[int, int], bt: int, size: int, ns: int, depth: int) -> None:
+        counters = table.get(bt)
+        if counters is None:
+            counters = table[bt] = [0, 0, 0]
+        counters[0] += 1
+        counters[1] += size
+        counters[2] += ns
+        depths[depth] = depths.get(depth, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        def types(table: Dict[int, list[int]]) -> Dict[int, Dict[str, int]]:
+            return {bt: {'count': count, 'bytes': size, 'ns': ns} for bt, (count, size, ns) in sorted(table.items())}
+        return {
+            'encode': types(self.encode),
+            'decode': types(self.decode),
+            'encode_depth': dict(sorted(self.encode_depth.items())),
+            'decode_depth': dict(sorted(self.decode_depth.items())),
+        }
+
+    def reset(self) -> None:
+        self.encode.clear()
+        self.decode.clear()
+        self.encode_depth.clear()
+        self.decode_depth.clear()
+
+
+class ProfiledEncoder:
+    # Обертка кодировщика: подставляется в Writer вместо самого кодировщика только при profile=True
+    __slots__ = ('encoder', 'profile')
+
+    def __init__(self, encoder: Encoder, profile: CodecProfile) -> None:
+        self.encoder = encoder
+        self.profile = profile
+
+    def __call__(self, writer: 'Writer', buf: bytearray, name: bytes, elem: Any) -> None:
+        depth = len(writer.stack)
+        start = len(buf)
+        t0 = perf_counter_ns()
+        self.encoder(writer, buf, name, elem)
+        ns = perf_counter_ns() - t0
+        # Открытый документ допишет завершающий ноль при закрытии
+        size = len(buf) - start - 1 - len(name) + (len(writer.stack) > depth)
+        profile = self.profile
+        profile.add(profile.encode, profile.encode_depth, buf[start], size, ns, depth)
+
+
+class ProfiledDecoder:
+    # Декодер элемента для profile=True, заводится на каждый вызов unmarshal. Документы и массивы
+    # разбирает сам, чтобы вложенные элементы тоже шли через него; nested - время вложенных элементов
+    def __init__(self, profile: CodecProfile) -> None:
+        self.profile = profile
+        self.depth = 1
+        self.nested = 0
+
+    def __call__(self, data: RawData, view: memoryview, bt: int, i: int, arrays: str | None = None,
+                 keep: 'TypeRestorer | None' = None, python_only: bool = False) -> tuple[Any, int]:
+        t0 = perf_counter_ns()
+        depth = self.depth
+        inner = 0
+        if bt == 3 or bt == 4:
+            amount_of_bytes_in_doc = struct.unpack_from('<i', view, i)[0]
+            nested, self.nested, self.depth = self.nested, 0, depth + 1
+            value: Any = None
+            size = 5
+            try:
+                if bt == 3:
+                    value = {}
+                    UnE_list(data, view, i + 4, i + amount_of_bytes_in_doc - 1, value, arrays, keep, self,
+                             python_only)
+                else:
+                    if arrays is not None:
+                        value = UnNumericArray(data, view, i + 4, i + amount_of_bytes_in_doc - 1, arrays)
+                        if value is not None:
+                            size = amount_of_bytes_in_doc
+                    if value is None:
+                        value = []
+                        UnE_array(data, view, i + 4, i + amount_of_bytes_in_doc - 1, value, arrays, keep, self,
+                                  python_only)
+            finally:
+                inner, self.nested, self.depth = self.nested, nested, depth
+            nxt = i + amount_of_bytes_in_doc
+        else:
+            value, nxt = UnElement(data, view, bt, i, arrays, keep, python_only)
+            size = nxt - i
+        ns = perf_counter_ns() - t0
+        self.nested += ns
+        profile = self.profile
+        profile.add(profile.decode, profile.decode_depth, bt, size, ns - inner, depth)
+        return value, nxt
+
+
+class Mapper:
+    # arrays: None - массивы декодируются в list; 'array' или 'numpy' - однородные числовые
+    # массивы декодируются в array.array или numpy.ndarray.
+    # keep_types: сохранять в __metadata__ кортежи, bytearray, именованные кортежи и датаклассы.
+    # profile: собирать CodecProfile; без него кодировщики и декодер элементов не обернуты
+    OPTIONS: Dict[str, Any] = {
+        'python_only': False,
+        'arrays': None,
+        'keep_types': False,
+        'profile': False,
+    }
 
-    # Проверка на словарь
-    if not isinstance(data, dict):
-        raise BsonUnsupportedObjectError
-    # Сортируем data по ключам и присваиваем к data
-    lst = []
-    new_data = {}
-    data_for = {}
-    for key in data:
-        lst.append(key)
-        data_for[key] = data[key]
-        if key == "lst":
-            raise BsonCycleDetectedError
+    def __init__(self, **kwargs: Any) -> None:
+        for name in kwargs:
+            if name not in self.OPTIONS:
+                raise MapperConfigError(name)
+        self._options = {**self.OPTIONS, **kwargs}
+        if self._options['arrays'] not in (None, 'array', 'numpy'):
+            raise MapperConfigError('arrays')
+        if self._options['arrays'] == 'numpy' and np is None:
+            raise MapperConfigError('arrays="numpy" requires numpy')
+        # Реестр кодировщиков: точные типы плюс закэшированные по мере появления подклассы
+        self._encoders = dict(ENCODERS)
+        self._shapes = ShapeCache()
+        # keep_types: маркеры по типам значений документа и готовые метаданные корня
+        self._markers: Dict[tuple[type, ...], tuple[Sequence[Any], bytes | None]] = {}
+        self._roots: Dict[tuple[Any, ...], bytes] = {}
+        # profile: обернутые кодировщики, их видит только Writer
+        self._profile = CodecProfile() if self._options['profile'] else None
+        self._profiled: Dict[type, Encoder] = {}
+
+    @property
+    def python_only(self) -> bool:
+        return bool(self._options['python_only'])
+
+    @property
+    def arrays(self) -> str | None:
+        return self._options['arrays']
+
+    @property
+    def keep_types(self) -> bool:
+        return bool(self._options['keep_types'])
+
+    @property
+    def profile(self) -> bool:
+        return bool(self._options['profile'])
+
+    @property
+    def shape_cache(self) -> ShapeCache:
+        return self._shapes
+
+    def profile_snapshot(self) -> Dict[str, Any]:
+        if self._profile is None:
+            raise MapperConfigError('profile')
+        return self._profile.snapshot()
+
+    @contextlib.contextmanager
+    def profiling(self) -> Iterator[CodecProfile]:
+        # Счетчики обнуляются на входе, так что снимок после блока относится только к нему
+        if self._profile is None:
+            raise MapperConfigError('profile')
+        self._profile.reset()
+        yield self._profile
+
+    def find_profiled_encoder(self, tp: type) -> Encoder:
+        assert self._profile is not None
+        encoder = self._profiled.get(tp)
+        if encoder is None:
+            encoder = self._profiled[tp] = ProfiledEncoder(self.find_encoder(tp), self._profile)
+        return encoder
+
+    def find_encoder(self, tp: type) -> Encoder:
+        encoder = self._encoders.get(tp)
+        if encoder is None:
+            if issubclass(tp, tuple) and hasattr(tp, '_fields'):
+                encoder = ClassSchema(tp, list(tp._fields))
+            elif dataclasses.is_dataclass(tp):
+                encoder = ClassSchema(tp, [field.name for field in dataclasses.fields(tp)])
+            else:
+                for base in tp.__mro__[1:]:
+                    if base in ENCODERS:
+                        encoder = ENCODERS[base]
+                        break
+                else:
+                    raise BsonUnsupportedObjectError
+            self._encoders[tp] = encoder
+        return encoder
+
+    def type_markers(self, values: Sequence[Any]) -> tuple[Sequence[Any], bytes | None]:
+        # Маркеры значений в порядке записи: '', 'tuple', 'bytearray' или ClassSchema, чей
+        # идентификатор назначается в каждом вызове marshal. Строка через двоеточие запоминается
+        # для каждого набора типов значений; None - в маркерах есть классы и строку собирает Writer
+        shape = tuple(map(type, values))
+        entry = self._markers.get(shape)
+        if entry is None:
+            kinds = {tp: self.type_marker(tp) for tp in set(shape)}
+            if not any(kinds.values()):
+                entry = ((), b'')
+            else:
+                markers = [kinds[tp] for tp in shape]
+                if any(isinstance(marker, ClassSchema) for marker in markers):
+                    entry = (markers, None)
+                else:
+                    entry = (markers, ':'.join(markers).encode())
+            if len(shape) <= MARKERS_SHAPE_LIMIT:
+                if len(self._markers) >= MARKERS_CACHE_LIMIT:
+                    self._markers.clear()
+                self._markers[shape] = entry
+        return entry
+
+    def type_marker(self, tp: type) -> Any:
+        if tp is types.GeneratorType:
+            # Генератор (только в marshal_to) читается обратно как список
+            return ''
+        encoder = self.find_encoder(tp)
+        if isinstance(encoder, ClassSchema):
+            return encoder
+        if issubclass(tp, bytearray):
+            return 'bytearray'
+        if issubclass(tp, tuple):
+            return 'tuple'
+        return ''
+
+    def root_metadata(self, type_ids: Dict[ClassSchema, str], text: bytes, root: ClassSchema | None) -> bytes:
+        # Метаданные корня со словарем типов: нулевой байт и сериализованный словарь
+        key = (tuple(type_ids), text, root)
+        blob = self._roots.get(key)
+        if blob is None:
+            meta: Dict[str, Any] = {
+                'types': {type_id: schema.description for schema, type_id in type_ids.items()},
+                'children': text.decode(),
+            }
+            if root is not None:
+                meta['self'] = type_ids[root]
+            blob = b'\x00' + DEFAULT_MAPPER.marshal(meta)
+            if len(self._roots) >= MARKERS_CACHE_LIMIT:
+                self._roots.clear()
+            self._roots[key] = blob
+        return blob
+
+    def marshal(self, data: Any) -> bytes:
+        writer = Writer(self)
+        writer.open_root(data)
+        writer.run()
+        return bytes(writer.buf)
+
+    def marshal_to(self, fileobj: BinaryIO, data: Any) -> int:
+        # Документ пишется в поток по мере кодирования и целиком в памяти не собирается.
+        # Размеры дописываются через seek, поэтому несмещаемый поток пишем через временный файл
+        if not fileobj.seekable():
+            with tempfile.SpooledTemporaryFile(SPOOL_BYTES) as spool:
+                size = self.marshal_to(spool, data)  # type: ignore[arg-type]
+                spool.seek(0)
+                shutil.copyfileobj(spool, fileobj)
+            return size
+        writer = StreamWriter(self, fileobj)
+        try:
+            writer.open_root(data)
+            writer.run()
+            return writer.finish()
+        except BaseException:
+            # Не оставляем в файле полдокумента
+            fileobj.seek(writer.origin)
+            fileobj.truncate()
+            raise
+
+    def unmarshal(self, data: bytes | bytearray | memoryview, fields: Iterable[str] | None = None) -> Any:
+        # Работаем по смещениям поверх memoryview, без копирования входа в список.
+        # fields - пути вида "user.address.city": декодируются только они, и keep_types к ним не применяется -
+        # проекция, как и LazyDocument, возвращает обычные словари и списки
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        with memoryview(data) as view:
+            return self.unmarshal_at(data, view, 0, len(data), fields)
+
+    def unmarshal_at(self, data: RawData, view: memoryview, start: int, end: int,
+                     fields: Iterable[str] | None = None) -> Any:
+        # Документ, занимающий data[start:end]. В режиме python_only типы, подтипы и "дырки"
+        # в индексах массивов проверяются прямо при разборе
+        python_only = self.python_only
+        new_data: Dict[Any, Any] = {}
+        if fields is None:
+            keep = TypeRestorer() if self._options['keep_types'] else None
+            element = UnElement if self._profile is None else ProfiledDecoder(self._profile)
+            UnE_list(data, view, start + 4, end - 1, new_data, self._options['arrays'], keep, element, python_only)
+            if keep is not None:
+                return keep.finish(new_data)
+        else:
+            UnE_list_projected(data, view, start + 4, end - 1, new_data, make_projection(fields),
+                               self._options['arrays'], python_only)
+        return new_data
+
+    def run_many(self, method: str, items: Iterable[Any], workers: int | None) -> list[Any]:
+        # Результат все равно собирается списком, так что вход тоже держим списком - нужна его длина
+        values = items if isinstance(items, list) else list(items)
+        if not values:
+            return []
+        first_result = getattr(self, method)(values[0])
+        if workers is not None and workers <= 1:
+            return [first_result] + [getattr(self, method)(item) for item in values[1:]]
+
+        # Размер пачки подбираем по первому документу: пересылка между процессами
+        # окупается только пачками порядка CHUNK_BYTES. Но пачек должно хватить на всех
+        # работников, по CHUNKS_PER_WORKER на каждого
+        sample_size = len(first_result) if method == 'marshal' else len(values[0])
+        share = -(-(len(values) - 1) // ((workers or os.cpu_count() or 1) * CHUNKS_PER_WORKER))
+        size = max(CHUNK_MIN_ITEMS, min(CHUNK_BYTES // max(sample_size, 1), share))
+        iterator = iter(values[1:])
+        chunks = iter(lambda: list(itertools.islice(iterator, size)), [])
+        result = [first_result]
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(self._options,)) as executor:
+            for chunk_result in executor.map(run_chunk, itertools.repeat(method), chunks):
+                result.extend(chunk_result)
+        return result
+
+    def marshal_many(self, items: Iterable[Any], workers: int | None = None) -> list[bytes]:
+        return self.run_many('marshal', items, workers)
+
+    def unmarshal_many(self, items: Iterable[bytes], workers: int | None = None) -> list[Dict[Any, Any]]:
+        # Восстановленные по __metadata__ классы создаются на лету и не переживают pickle
+        # по дороге из процесса-работника, поэтому с keep_types разбираем все здесь
+        if self._options['keep_types']:
+            workers = 1
+        return self.run_many('unmarshal', items, workers)
+
+
+DEFAULT_MAPPER = Mapper()
+
+
+class Frame:
+    # Открытый, но еще не дописанный документ: где начинается и какой элемент писать следующим
+    __slots__ = ('start', 'names', 'values', 'encoders', 'i', 'container', 'rest', 'count', 'kinds')
+
+    def __init__(self, start: int, names: Sequence[bytes], values: Sequence[Any],
+                 encoders: list[Encoder], container: int) -> None:
+        self.start = start
+        self.names = names
+        self.values = values
+        self.encoders = encoders
+        self.i = 0
+        self.container = container
+        # Для массива из генератора: откуда брать следующую пачку и сколько элементов уже записано
+        self.rest: Iterator[Any] | None = None
+        self.count = 0
+        # keep_types: маркеры значений и их строка (см. Mapper.type_markers)
+        self.kinds: tuple[Sequence[Any], bytes | None] | None = None
+
+
+class Writer:
+    # Состояние одного вызова marshal. Весь документ пишется в один буфер, размеры вложенных
+    # документов дописываются по месту. Вложенность обходится явным стеком, а не рекурсией,
+    # а в path лежат id контейнеров на текущем пути - по ним за O(1) ловим циклы.
+    # Позиции в Frame.start отсчитываются от начала документа, buf начинается с позиции base
+    limit = INT32_MAX
+
+    def __init__(self, mapper: Mapper) -> None:
+        self.mapper = mapper
+        self.buf = bytearray()
+        self.base = 0
+        self.stack: list[Frame] = []
+        self.path: set[int] = set()
+        # keep_types: идентификаторы встреченных классов в порядке обхода и класс корня
+        self.keep_types = mapper.keep_types
+        self.type_ids: Dict[ClassSchema, str] = {}
+        self.root_schema: ClassSchema | None = None
+        # При profile=True вместо кодировщиков - их обертки со счетчиками
+        if mapper._profile is None:
+            self.encoders, self.find_encoder = mapper._encoders, mapper.find_encoder
+        else:
+            self.encoders, self.find_encoder = mapper._profiled, mapper.find_profiled_encoder
 
-        if not isinstance(key, str):
-            raise BsonUnsupportedKeyError
-        if key.find('\x00') != -1:
-            raise BsonKeyWithZeroByteError
-        if data[key] == data:
+    def open_items(self, container: Any, names: Sequence[bytes], values: Sequence[Any]) -> None:
+        if id(container) in self.path:
             raise BsonCycleDetectedError
-        '''if isinstance(data[key], dict):
-            kl = True
-            while kl:
-                for elem in data[key]:
-                    if data[key][elem] == data:
-                        raise BsonCycleDetectedError
-
-        '''
-
-    flag = False
-    for elem in lst:
-        if not elem.isdigit():
-            flag = True
-    if flag:
-        lst.sort()
-    for elem in lst:
-        new_data[elem] = data[elem]
-    data = new_data
-    e_list = E_list(data, data_for)
-    return Document(e_list)
-
-
-def unmarshal(data: bytes) -> Dict[Any, Any]:
-    old_data = list(data)
-    new_data: Dict[Any, Any] = {}
-    UnE_list(old_data[4:-1], new_data)
-    return new_data
+        # Кодировщики всех значений находим до записи: неподдерживаемое значение не должно оставлять полдокумента
+        encoders = self.encoders
+        find_encoder = self.find_encoder
+        found = [encoders.get(type(value)) or find_encoder(type(value)) for value in values]
+        self.path.add(id(container))
+        frame = Frame(self.base + len(self.buf), names, values, found, id(container))
+        if self.keep_types:
+            frame.kinds = self.mapper.type_markers(values)
+        self.stack.append(frame)
+        self.buf += bytes(4)
+
+    def open_document(self, data: Dict[Any, Any]) -> None:
+        shape = tuple(data)
+        entry = self.mapper._shapes.get(shape)
+        if entry is None:
+            # Порядок проверок: нестроковые ключи, нулевые байты в ключах, неподдерживаемые значения
+            for key in data:
+                if not isinstance(key, str):
+                    raise BsonUnsupportedKeyError
+            for key in data:
+                if '\x00' in key:
+                    raise BsonKeyWithZeroByteError
+            entry = self.mapper._shapes.add(shape, sorted(data))
+        keys, names = entry
+        self.open_items(data, names, [data[key] for key in keys])
+
+    def open_array(self, elem: list[Any] | tuple[Any, ...]) -> None:
+        self.open_items(elem, index_names(0, len(elem)), elem)
+
+    def open_iterator(self, elem: Iterator[Any]) -> None:
+        self.open_items(elem, [], [])
+        self.stack[-1].rest = elem
+        if self.keep_types:
+            self.stack[-1].kinds = ([], None)
+
+    def refill(self, frame: Frame) -> bool:
+        assert frame.rest is not None
+        frame.count += len(frame.values)
+        values = list(itertools.islice(frame.rest, ITER_CHUNK))
+        if not values:
+            return False
+        frame.names = index_names(frame.count, frame.count + len(values))
+        frame.values = values
+        encoders = self.encoders
+        find_encoder = self.find_encoder
+        frame.encoders = [encoders.get(type(value)) or find_encoder(type(value)) for value in values]
+        frame.i = 0
+        if frame.kinds is not None:
+            markers = self.mapper.type_markers(values)[0]
+            frame.kinds[0].extend(markers or [''] * len(values))  # type: ignore[attr-defined]
+        return True
+
+    def overflow(self) -> None:
+        raise BsonDocumentTooBigError
+
+    def close_document(self, start: int) -> None:
+        end_document(self.buf, start - self.base)
+
+    def open_root(self, data: Any) -> None:
+        # Корнем может быть словарь, именованный кортеж или датакласс
+        if isinstance(data, dict):
+            self.open_document(data)
+            return
+        encoder = self.mapper.find_encoder(type(data))
+        if not isinstance(encoder, ClassSchema):
+            raise BsonUnsupportedObjectError
+        if self.keep_types:
+            self.type_id(encoder)
+            self.root_schema = encoder
+        self.open_items(data, encoder.names, encoder.values(data))
+
+    def type_id(self, schema: ClassSchema) -> None:
+        # nt-0, dc-1, ...: общая нумерация в порядке обхода
+        if schema not in self.type_ids:
+            self.type_ids[schema] = f'{schema.kind}-{len(self.type_ids)}'
+
+    def write_metadata(self, frame: Frame) -> None:
+        # Дописываем __metadata__ в конец закрываемого документа; корень уже снят со стека
+        assert frame.kinds is not None
+        markers, text = frame.kinds
+        if text is None:
+            type_ids = self.type_ids
+            text = ':'.join([marker if type(marker) is str else type_ids[marker] for marker in markers]).encode() \
+                if any(markers) else b''
+        if not self.stack and self.type_ids:
+            text = self.mapper.root_metadata(self.type_ids, text, self.root_schema)
+        if text:
+            buf = self.buf
+            buf.append(5)
+            buf += METADATA_NAME
+            buf += struct.pack('<iB', len(text), METADATA_SUBTYPE)
+            buf += text
+            if len(buf) > self.limit:
+                self.overflow()
+
+    def run(self) -> None:
+        buf = self.buf
+        stack = self.stack
+        limit = self.limit
+        while stack:
+            frame = stack[-1]
+            depth = len(stack)
+            names, values, encoders = frame.names, frame.values, frame.encoders
+            i = frame.i
+            # Пишем элементы текущего документа, пока не откроется вложенный
+            while i < len(values):
+                encoders[i](self, buf, names[i], values[i])
+                i += 1
+                if len(buf) > limit:
+                    self.overflow()
+                if len(stack) != depth:
+                    break
+            frame.i = i
+            if len(stack) == depth:
+                if frame.rest is not None and self.refill(frame):
+                    continue
+                stack.pop()
+                self.path.discard(frame.container)
+                if frame.kinds is not None:
+                    self.write_metadata(frame)
+                self.close_document(frame.start)
+
+
+# Потоковая запись: буфер сбрасывается в файл, как только превышает FLUSH_BYTES
+FLUSH_BYTES = 1 << 20
+SPOOL_BYTES = 16 << 20
+ITER_CHUNK = 1024
+
+
+class StreamWriter(Writer):
+    # Writer, у которого начало буфера уже лежит в файле. Размер документа, начало которого
+    # успело уйти в файл, вписывается через seek, остальные - прямо в буфере
+    limit = FLUSH_BYTES
+
+    def __init__(self, mapper: Mapper, fileobj: BinaryIO) -> None:
+        super().__init__(mapper)
+        self.file = fileobj
+        self.origin = fileobj.tell()
+        # Генераторы пишутся только в поток: в marshal их пришлось бы целиком держать в памяти
+        self.generator_encoder: Encoder = encode_generator if mapper._profile is None \
+            else ProfiledEncoder(encode_generator, mapper._profile)
+        self.find_mapper_encoder = self.find_encoder
+        self.find_encoder = self.find_stream_encoder
+
+    def find_stream_encoder(self, tp: type) -> Encoder:
+        if tp is types.GeneratorType:
+            return self.generator_encoder
+        return self.find_mapper_encoder(tp)
+
+    def overflow(self) -> None:
+        if self.base + len(self.buf) > INT32_MAX:
+            raise BsonDocumentTooBigError
+        self.file.write(self.buf)
+        self.base += len(self.buf)
+        self.buf.clear()
+
+    def close_document(self, start: int) -> None:
+        if start >= self.base:
+            end_document(self.buf, start - self.base)
+            return
+        # Начало документа уже в файле: размер вписываем через seek
+        self.buf.append(0)
+        size = self.base + len(self.buf) - start
+        if size > INT32_MAX:
+            raise BsonDocumentTooBigError
+        self.file.seek(self.origin + start)
+        self.file.write(struct.pack('<i', size))
+        self.file.seek(self.origin + self.base)
+
+    def finish(self) -> int:
+        self.overflow()
+        return self.base
+
+
+# Пакетная обработка в пуле процессов: каждый процесс один раз получает настройки и строит свой Mapper
+CHUNK_BYTES = 1 << 20
+CHUNK_MIN_ITEMS = 16
+CHUNKS_PER_WORKER = 4
+WORKER_MAPPER = DEFAULT_MAPPER
+
+
+def init_worker(options: Dict[str, Any]) -> None:
+    global WORKER_MAPPER
+    WORKER_MAPPER = Mapper(**options)
+
+
+def run_chunk(method: str, chunk: list[Any]) -> list[Any]:
+    run = getattr(WORKER_MAPPER, method)
+    return [run(item) for item in chunk]
+
+
+def marshal(data: Any) -> bytes:
+    return DEFAULT_MAPPER.marshal(data)
+
+
+def unmarshal(data: bytes | bytearray | memoryview) -> Dict[Any, Any]:
+    return DEFAULT_MAPPER.unmarshal(data)
+
+
+# Размер значения для всех типов элементов из спецификации BSON (127 и 255 - MaxKey/MinKey),
+# -1 - размер переменный
+VALUE_SIZES = {1: 8, 2: -1, 3: -1, 4: -1, 5: -1, 6: 0, 7: 12, 8: 1, 9: 8, 10: 0, 11: -1, 12: -1, 13: -1,
+               14: -1, 15: -1, 16: 4, 17: 8, 18: 8, 19: 16, 127: 0, 255: 0}
+# Типы, которые порождает наш marshal (None у нас - тип 6)
+PYTHON_ONLY_SIZES = {bt: VALUE_SIZES[bt] for bt in (1, 2, 3, 4, 5, 6, 8, 9, 16, 18)}
+UTF8 = re.compile(
+    rb'(?:[\x00-\x7f]+|[\xc2-\xdf][\x80-\xbf]|\xe0[\xa0-\xbf][\x80-\xbf]|[\xe1-\xec\xee\xef][\x80-\xbf]{2}'
+    rb'|\xed[\x80-\x9f][\x80-\xbf]|\xf0[\x90-\xbf][\x80-\xbf]{2}|[\xf1-\xf3][\x80-\xbf]{3}'
+    rb'|\xf4[\x80-\x8f][\x80-\xbf]{2})*'
+)
+ARRAY_INDEX = re.compile(rb'0|[1-9][0-9]*')
+
+
+def check_string(data: RawData, i: int, end: int) -> int:
+    # string ::= int32 (byte*) 0; end - позиция завершающего нуля объемлющего документа
+    if i + 4 > end:
+        raise BsonBrokenDataError
+    size = struct.unpack_from('<i', data, i)[0]
+    if size < 1:
+        raise BsonStringSizeError
+    nxt = i + 4 + size
+    if nxt > end:
+        raise BsonInconsistentStringSizeError
+    if data[nxt - 1] != 0:
+        raise BsonBrokenDataError
+    if UTF8.fullmatch(data, i + 4, nxt - 1) is None:
+        raise BsonBadStringDataError
+    return nxt
+
+
+def check_cstring(data: RawData, i: int, end: int) -> int:
+    k = data.find(b'\x00', i, end)
+    if k == -1:
+        raise BsonBrokenDataError
+    if UTF8.fullmatch(data, i, k) is None:
+        raise BsonBadStringDataError
+    return k + 1
+
+
+def validate(buf: RawData, python_only: bool = False, start: int = 0, stop: int | None = None) -> None:
+    # Проверяет структуру документа за один проход, ничего не декодируя;
+    # буфер читается как есть, в bytes копируются только ключи для set, а индексы массивов
+    # сравниваются с готовыми именами из ARRAY_KEYS, как в UnE_array.
+    # start и stop - границы документа внутри буфера, по умолчанию весь буфер
+    data = buf
+    if stop is None:
+        stop = len(data)
+    if stop - start < 4:
+        raise BsonBrokenDataError
+    size = struct.unpack_from('<i', data, start)[0]
+    if size < 5:
+        raise BsonIncorrectSizeError
+    if size < stop - start:
+        raise BsonTooManyDataError
+    if size > stop - start:
+        raise BsonNotEnoughDataError
+    if data[start + size - 1] != 0:
+        raise BsonBrokenDataError
+    sizes = PYTHON_ONLY_SIZES if python_only else VALUE_SIZES
+
+    # Состояние текущего документа: позиция завершающего нуля, массив ли это,
+    # следующий ожидаемый индекс и встреченные ключи (заводятся только при необходимости)
+    end, is_array, index, seen = start + size - 1, False, 0, None
+    stack: list[tuple[int, bool, int, Any]] = []
+    names: Sequence[bytes] = ARRAY_KEYS
+    i = start + 4
+    while True:
+        if i == end:
+            if not stack:
+                return None
+            i = end + 1
+            end, is_array, index, seen = stack.pop()
+            continue
+
+        bt = data[i]
+        k = data.find(b'\x00', i + 1, end)
+        if k == -1:
+            raise BsonBrokenDataError
+        if bt == 5 and k == i + len(METADATA_KEY) + 1 and k + 5 < end and data[k + 5] == METADATA_SUBTYPE \
+                and data[i + 1:k + 1] == METADATA_NAME:
+            # Метаданные keep_types: не ключ документа и не индекс массива, допустимы и в python_only
+            n = struct.unpack_from('<i', data, k + 1)[0]
+            if n < 0:
+                raise BsonBrokenDataError
+            i = k + 6 + n
+            if i > end:
+                raise BsonBrokenDataError
+            continue
+        if is_array:
+            if index >= len(names):
+                names = index_names(0, 2 * index + 16)
+            name = names[index]
+            if seen is None and data[i + 1:k + 1] == name:
+                index += 1
+            elif ARRAY_INDEX.fullmatch(data, i + 1, k) is None:
+                raise BsonBadArrayIndexError
+            else:
+                n = int(data[i + 1:k])
+                if python_only:
+                    # индексы идут подряд, значит меньший индекс уже встречался
+                    if n < index:
+                        raise BsonRepeatedKeyDataError
+                    raise BsonInvalidArrayError
+                if seen is None:
+                    seen = set(range(index))
+                if n in seen:
+                    raise BsonRepeatedKeyDataError
+                seen.add(n)
+        else:
+            key = bytes(data[i + 1:k])
+            if not key.isascii() and UTF8.fullmatch(key) is None:
+                raise BsonBadKeyDataError
+            if seen is None:
+                seen = {key}
+            elif key in seen:
+                raise BsonRepeatedKeyDataError
+            else:
+                seen.add(key)
+        step = sizes.get(bt)
+        if step is None:
+            raise BsonInvalidElementTypeError
+        i = k + 1
+
+        if step >= 0:
+            i += step
+        elif bt == 2 or bt == 13 or bt == 14:
+            i = check_string(data, i, end)
+        elif bt == 5:
+            if i + 5 > end:
+                raise BsonBrokenDataError
+            n = struct.unpack_from('<i', data, i)[0]
+            subtype = data[i + 4]
+            if n < 0:
+                raise BsonBrokenDataError
+            if subtype != 0 and (python_only or 9 < subtype < 128):
+                raise BsonInvalidBinarySubtypeError
+            i += 5 + n
+        elif bt == 11:
+            i = check_cstring(data, check_cstring(data, i, end), end)
+        elif bt == 12:
+            i = check_string(data, i, end) + 12
+        else:
+            # 3, 4 и 15: дальше разбираем вложенный документ, состояние текущего - в стек
+            if bt == 15:
+                if i + 4 > end:
+                    raise BsonBrokenDataError
+                total = i + struct.unpack_from('<i', data, i)[0]
+                i = check_string(data, i + 4, end)
+            if i + 4 > end:
+                raise BsonBrokenDataError
+            n = struct.unpack_from('<i', data, i)[0]
+            if n < 5:
+                raise BsonIncorrectSizeError
+            if i + n > end or data[i + n - 1] != 0 or (bt == 15 and i + n != total):
+                raise BsonBrokenDataError
+            stack.append((end, is_array, index, seen))
+            end, is_array, index, seen = i + n - 1, bt == 4, 0, None
+            i += 4
+            continue
+        if i > end:
+            raise BsonBrokenDataError
+
+
+def read_into(stream: io.BufferedIOBase, view: memoryview) -> int:
+    # Сокеты и небуферизованные потоки могут отдавать данные частями
+    got = 0
+    while got < len(view):
+        n = stream.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+
+def iter_documents(stream: io.BufferedIOBase) -> Iterator[Dict[Any, Any]]:
+    for doc in iter_raw_documents(stream):
+        yield DEFAULT_MAPPER.unmarshal(doc)
+
+
+def iter_raw_documents(stream: io.BufferedIOBase) -> Iterator[bytearray]:
+    # Поток из подряд записанных документов (как у bsondump): читаем размер, затем ровно один документ
+    header = bytearray(4)
+    while True:
+        got = read_into(stream, memoryview(header))
+        if got == 0:
+            return
+        if got < 4:
+            raise BsonNotEnoughDataError
+        size = struct.unpack('<i', header)[0]
+        if size < 5:
+            raise BsonIncorrectSizeError
+        doc = bytearray(size)
+        doc[:4] = header
+        with memoryview(doc) as view:
+            if read_into(stream, view[4:]) < size - 4:
+                raise BsonNotEnoughDataError
+        yield doc
+
+
+class MappedCollection(Sequence[Dict[Any, Any]]):
+    # Файл из подряд записанных документов, отображенный в память. Индекс смещений документов
+    # строится одним проходом по заголовкам и сохраняется рядом (path + '.idx'), чтобы при
+    # следующем открытии не сканировать файл заново
+    def __init__(self, path: str | os.PathLike[str], persist_index: bool = True, mapper: Mapper | None = None) -> None:
+        self.path = os.fspath(path)
+        self.index_path = self.path + '.idx'
+        self.mapper = mapper or DEFAULT_MAPPER
+        self._file = open(self.path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self._stamp = array('q', [stat.st_size, stat.st_mtime_ns])
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else None
+        try:
+            offsets = self.load_index()
+            if offsets is None:
+                offsets = self.build_index()
+                if persist_index:
+                    self.save_index(offsets)
+        except BaseException:
+            self.close()
+            raise
+        self._offsets = offsets
+
+    def build_index(self) -> 'array[int]':
+        offsets = array('q', [0])
+        size = self._stamp[0]
+        pos = 0
+        while pos < size:
+            if pos + 4 > size:
+                raise BsonNotEnoughDataError
+            assert self._mmap is not None
+            doc_size = struct.unpack_from('<i', self._mmap, pos)[0]
+            if doc_size < 5:
+                raise BsonIncorrectSizeError
+            pos += doc_size
+            if pos > size:
+                raise BsonNotEnoughDataError
+            offsets.append(pos)
+        return offsets
+
+    def load_index(self) -> 'array[int] | None':
+        # В начале индекса - размер и время изменения файла, по которым он строился
+        try:
+            with open(self.index_path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return None
+        offsets = array('q')
+        if len(raw) % offsets.itemsize:
+            return None
+        offsets.frombytes(raw)
+        # Обрезанный индекс (например, прерванная запись) не доходит до конца файла
+        if offsets[:2] != self._stamp or len(offsets) < 3 or offsets[2] != 0 or offsets[-1] != self._stamp[0]:
+            return None
+        return offsets[2:]
+
+    def save_index(self, offsets: 'array[int]') -> None:
+        # Пишем во временный файл и подменяем: читатель видит либо старый индекс, либо целиком новый
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self._stamp.tobytes())
+                f.write(offsets.tobytes())
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    @overload
+    def __getitem__(self, i: int) -> Dict[Any, Any]: ...
+
+    @overload
+    def __getitem__(self, i: slice) -> list[Dict[Any, Any]]: ...
+
+    def __getitem__(self, i: int | slice) -> Dict[Any, Any] | list[Dict[Any, Any]]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        assert self._mmap is not None
+        with memoryview(self._mmap) as view:
+            return self.mapper.unmarshal_at(self._mmap, view, self._offsets[i], self._offsets[i + 1])
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> 'MappedCollection':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+# Архив документов в сжатых zlib блоках: блоки подряд, за ними индекс и концевик.
+# Запись индекса - смещение блока, число документов в нем и номер первого документа;
+# концевик - смещение индекса, число блоков и метка формата
+BLOCK_BYTES = 1 << 20
+BLOCK_LEVEL = 6
+BLOCK_MAGIC = b'BSZ1'
+BLOCK_RECORD = struct.Struct('<qqq')
+BLOCK_FOOTER = struct.Struct('<qq4s')
+
+
+class BlockWriter:
+    # Документы копятся в несжатом блоке, блок сжимается и пишется, как только дорастет до block_bytes.
+    # Индекс и концевик дописываются в close
+    def __init__(self, path: str | os.PathLike[str], block_bytes: int = BLOCK_BYTES, level: int = BLOCK_LEVEL,
+                 mapper: Mapper | None = None) -> None:
+        self.path = os.fspath(path)
+        self.block_bytes = block_bytes
+        self.level = level
+        self.mapper = mapper or DEFAULT_MAPPER
+        self._file = open(self.path, 'wb')
+        self._block = bytearray()
+        self._count = 0
+        self._written = 0
+        self._index: list[tuple[int, int, int]] = []
+
+    def write(self, doc: Any) -> int:
+        # Возвращает номер документа в архиве
+        self._block += self.mapper.marshal(doc)
+        self._count += 1
+        if len(self._block) >= self.block_bytes:
+            self.flush_block()
+        return self._written + self._count - 1
+
+    def flush_block(self) -> None:
+        if not self._count:
+            return
+        self._index.append((self._file.tell(), self._count, self._written))
+        self._file.write(zlib.compress(self._block, self.level))
+        self._written += self._count
+        self._block.clear()
+        self._count = 0
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        try:
+            self.flush_block()
+            index_offset = self._file.tell()
+            self._file.write(b''.join(BLOCK_RECORD.pack(*record) for record in self._index))
+            self._file.write(BLOCK_FOOTER.pack(index_offset, len(self._index), BLOCK_MAGIC))
+        finally:
+            self._file.close()
+
+    def __len__(self) -> int:
+        return self._written + self._count
+
+    def __enter__(self) -> 'BlockWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+class BlockReader(Sequence[Dict[Any, Any]]):
+    # Архив BlockWriter, отображенный в память. По номеру документа распаковывается только его блок,
+    # последний распакованный блок запоминается. При переборе блоки распаковываются наперед в пуле
+    # потоков: zlib отпускает GIL, и распаковка следующих блоков идет параллельно разбору документов
+    def __init__(self, path: str | os.PathLike[str], mapper: Mapper | None = None, workers: int | None = None) -> None:
+        self.path = os.fspath(path)
+        self.mapper = mapper or DEFAULT_MAPPER
+        self.workers = workers or os.cpu_count() or 1
+        self._file = open(self.path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        # offsets - смещения блоков и, последним, индекса; firsts - номера первых документов блоков
+        self._offsets = array('q')
+        self._counts = array('q')
+        self._firsts = array('q')
+        self._cached: tuple[int, bytes, list[int]] | None = None
+        try:
+            self.read_index(size)
+        except BaseException:
+            self.close()
+            raise
+
+    def read_index(self, size: int) -> None:
+        if size < BLOCK_FOOTER.size:
+            raise BsonNotEnoughDataError
+        assert self._mmap is not None
+        index_offset, blocks, magic = BLOCK_FOOTER.unpack_from(self._mmap, size - BLOCK_FOOTER.size)
+        if magic != BLOCK_MAGIC or blocks < 0 or index_offset + blocks * BLOCK_RECORD.size != size - BLOCK_FOOTER.size:
+            raise BsonBrokenDataError
+        total = 0
+        for offset, count, first in BLOCK_RECORD.iter_unpack(self._mmap[index_offset:size - BLOCK_FOOTER.size]):
+            if first != total or count < 1 or offset < (self._offsets[-1] if self._offsets else 0):
+                raise BsonBrokenDataError
+            self._offsets.append(offset)
+            self._counts.append(count)
+            self._firsts.append(first)
+            total += count
+        if self._offsets and self._offsets[-1] > index_offset:
+            raise BsonBrokenDataError
+        self._offsets.append(index_offset)
+
+    def read_block(self, b: int) -> bytes:
+        assert self._mmap is not None
+        try:
+            return zlib.decompress(self._mmap[self._offsets[b]:self._offsets[b + 1]])
+        except zlib.error as e:
+            raise BsonBrokenDataError from e
+
+    def block_offsets(self, b: int, data: bytes) -> list[int]:
+        # Смещения документов распакованного блока, последним - конец блока
+        offsets = [0]
+        pos = 0
+        while pos < len(data):
+            if pos + 4 > len(data):
+                raise BsonNotEnoughDataError
+            size = struct.unpack_from('<i', data, pos)[0]
+            if size < 5:
+                raise BsonIncorrectSizeError
+            pos += size
+            offsets.append(pos)
+        if pos > len(data):
+            raise BsonNotEnoughDataError
+        if len(offsets) - 1 != self._counts[b]:
+            raise BsonBrokenDataError
+        return offsets
+
+    def __len__(self) -> int:
+        return self._firsts[-1] + self._counts[-1] if self._counts else 0
+
+    @overload
+    def __getitem__(self, i: int) -> Dict[Any, Any]: ...
+
+    @overload
+    def __getitem__(self, i: slice) -> list[Dict[Any, Any]]: ...
+
+    def __getitem__(self, i: int | slice) -> Dict[Any, Any] | list[Dict[Any, Any]]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        b = bisect.bisect_right(self._firsts, i) - 1
+        if self._cached is None or self._cached[0] != b:
+            data = self.read_block(b)
+            self._cached = (b, data, self.block_offsets(b, data))
+        _, data, offsets = self._cached
+        k = i - self._firsts[b]
+        with memoryview(data) as view:
+            return self.mapper.unmarshal_at(data, view, offsets[k], offsets[k + 1])
+
+    def __iter__(self) -> Iterator[Dict[Any, Any]]:
+        # Наперед распаковывается не больше 2 * workers блоков
+        executor = ThreadPoolExecutor(self.workers)
+        try:
+            blocks = iter(range(len(self._counts)))
+            pending: deque[tuple[int, Future[bytes]]] = deque(
+                (b, executor.submit(self.read_block, b)) for b in itertools.islice(blocks, 2 * self.workers))
+            while pending:
+                b, future = pending.popleft()
+                for nxt in itertools.islice(blocks, 1):
+                    pending.append((nxt, executor.submit(self.read_block, nxt)))
+                data = future.result()
+                offsets = self.block_offsets(b, data)
+                with memoryview(data) as view:
+                    for k in range(len(offsets) - 1):
+                        yield self.mapper.unmarshal_at(data, view, offsets[k], offsets[k + 1])
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def close(self) -> None:
+        self._cached = None
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> 'BlockReader':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+# Колонка хранится в массиве numpy фиксированного типа; вид по типу элемента BSON:
+# 1 - float64, 2 - строки (object), 8 - bool (байты, нормализуются в конце), 9 - datetime64[ms] (int64),
+# 18 - int64 (в том числе из int32)
+COLUMN_KINDS = {1: 1, 2: 2, 8: 8, 9: 9, 16: 18, 18: 18}
+COLUMN_TYPES = {float: 1, str: 2, bool: 8, datetime: 9, int: 18}
+COLUMN_STORAGE = {1: 'float64', 2: 'object', 8: 'uint8', 9: 'int64', 18: 'int64'}
+COLUMNS_CAPACITY = 1024
+SCHEMA_SAMPLE = 16
+
+
+class Column:
+    __slots__ = ('name', 'kind', 'values', 'raw', 'row')
+
+    def __init__(self, name: str, kind: int, capacity: int) -> None:
+        self.name = name
+        self.kind = kind
+        self.values = self.allocate(capacity)
+        self.raw = memoryview(self.values).cast('B') if kind != 2 else None
+        # последняя строка, в которую записано значение
+        self.row = -1
+
+    def allocate(self, capacity: int) -> Any:
+        values = np.empty(capacity, COLUMN_STORAGE[self.kind])
+        if self.kind == 1:
+            values.fill(np.nan)
+        elif self.kind == 9:
+            values.fill(INT64_MIN)  # NaT
+        elif self.kind == 2:
+            values.fill(None)
+        return values
+
+    def grow(self) -> None:
+        old = self.values
+        self.values = self.allocate(2 * len(old))
+        self.values[:len(old)] = old
+        if self.raw is not None:
+            self.raw.release()
+            self.raw = memoryview(self.values).cast('B')
+
+    def result(self, rows: int) -> Any:
+        values = self.values[:rows]
+        if self.raw is not None:
+            self.raw.release()
+            self.raw = None
+        if self.kind == 8:
+            return values != 0
+        if self.kind == 9:
+            return values.view('datetime64[ms]')
+        return values
+
+
+def document_spans(source: Any) -> Iterator[tuple[bytes, memoryview, int]]:
+    # Поток - документы читаются по одному; буфер - документы идут в нем подряд.
+    # Данные всегда bytes: срезы ключей используются как ключи словаря колонок.
+    # view не закрываем явно: первые документы живут дольше генератора (выборка для схемы)
+    if hasattr(source, 'readinto'):
+        for doc in iter_raw_documents(source):
+            data = bytes(doc)
+            yield data, memoryview(data), 0
+        return
+    data = source if isinstance(source, bytes) else bytes(source)
+    view = memoryview(data)
+    pos = 0
+    while pos < len(data):
+        if pos + 4 > len(data):
+            raise BsonNotEnoughDataError
+        size = struct.unpack_from('<i', view, pos)[0]
+        if size < 5:
+            raise BsonIncorrectSizeError
+        if pos + size > len(data):
+            raise BsonNotEnoughDataError
+        yield data, view, pos
+        pos += size
+
+
+def infer_schema(spans: Iterable[tuple[bytes, memoryview, int]]) -> Dict[str, int]:
+    # Схема по первым документам: поля скалярных типов в порядке появления, int и float сводятся к float
+    kinds: Dict[str, int] = {}
+    for data, view, start in spans:
+        i = start + 4
+        end = start + struct.unpack_from('<i', view, start)[0] - 1
+        while i < end:
+            bt = data[i]
+            key, i = make_key(data, view, i)
+            i = skip_element(data, view, bt, i)
+            kind = COLUMN_KINDS.get(bt)
+            if kind is None:
+                continue
+            seen = kinds.setdefault(key, kind)
+            if seen != kind:
+                if {seen, kind} != {1, 18}:
+                    raise BsonSchemaMismatchError(key)
+                kinds[key] = 1
+        if i != end or data[end] != 0:
+            raise BsonBrokenDataError
+    return kinds
+
+
+def to_columns(source: Any, schema: Dict[str, type] | None = None, frame: bool = False) -> Any:
+    if np is None:
+        raise ImportError('to_columns requires numpy')
+    if frame and pd is None:
+        raise ImportError('to_columns(frame=True) requires pandas')
+    spans = document_spans(source)
+    pending = list(itertools.islice(spans, SCHEMA_SAMPLE))
+    if schema is None:
+        kinds = infer_schema(pending)
+    else:
+        kinds = {}
+        for name, tp in schema.items():
+            if tp not in COLUMN_TYPES:
+                raise TypeError(f'unsupported column type {tp!r}')
+            kinds[name] = COLUMN_TYPES[tp]
+
+    capacity = COLUMNS_CAPACITY
+    columns = [Column(name, kind, capacity) for name, kind in kinds.items()]
+    by_key = {column.name.encode(): column for column in columns}
+    row = 0
+    for data, view, start in itertools.chain(pending, spans):
+        if row == capacity:
+            for column in columns:
+                column.grow()
+            capacity *= 2
+        i = start + 4
+        end = start + struct.unpack_from('<i', view, start)[0] - 1
+        written = 0
+        while i < end:
+            bt = data[i]
+            # ключи сравниваются в сыром виде, без декодирования
+            k = data.find(b'\x00', i + 1)
+            if k == -1:
+                raise BsonBrokenDataError
+            found = by_key.get(data[i + 1:k])
+            i = k + 1
+            if found is None or bt == 6:
+                i = skip_element(data, view, bt, i)
+                continue
+            column = found
+            kind = column.kind
+            # float64, int64 и datetime лежат в BSON в том же little-endian виде, что и в колонке
+            if bt == kind and (bt == 1 or bt == 18 or bt == 9):
+                assert column.raw is not None
+                column.raw[8 * row:8 * row + 8] = view[i:i + 8]
+                i += 8
+            elif bt == 16 and (kind == 18 or kind == 1):
+                column.values[row] = struct.unpack_from('<i', view, i)[0]
+                i += 4
+            elif bt == 18 and kind == 1:
+                column.values[row] = struct.unpack_from('<q', view, i)[0]
+                i += 8
+            elif bt == 8 and kind == 8:
+                assert column.raw is not None
+                column.raw[row] = data[i]
+                i += 1
+            elif bt == 2 and kind == 2:
+                n = struct.unpack_from('<i', view, i)[0]
+                if n < 1:
+                    raise BsonStringSizeError
+                column.values[row] = codecs.utf_8_decode(view[i + 4:i + 3 + n])[0]
+                i += 4 + n
+            else:
+                raise BsonSchemaMismatchError(column.name)
+            column.row = row
+            written += 1
+        # Документы заранее не проверяются: последний элемент должен закончиться ровно на завершающем нуле
+        if i != end or data[end] != 0:
+            raise BsonBrokenDataError
+        if written != len(columns):
+            # пропущенные значения остаются NaN/NaT/None, для int и bool пропуск - ошибка
+            for column in columns:
+                if column.row != row and (column.kind == 18 or column.kind == 8):
+                    raise BsonSchemaMismatchError(column.name)
+        row += 1
+
+    result = {column.name: column.result(row) for column in columns}
+    if frame:
+        return pd.DataFrame(result, copy=False)
+    return result
+
+
+# Обмен документами через asyncio: документ сам несет свой размер в первых 4 байтах,
+# поэтому отдельный заголовок кадра не нужен. Данные из сети не доверенные: размер
+# ограничен MAX_DOCUMENT_SIZE, а документ проверяется validate до декодирования
+RECV_BUFFER = 1 << 16
+MAX_DOCUMENT_SIZE = 16 << 20
+
+
+async def read_document(reader: asyncio.StreamReader, mapper: Mapper | None = None,
+                        max_document_size: int = MAX_DOCUMENT_SIZE) -> Dict[Any, Any] | None:
+    # None - соединение закрыто между документами
+    mapper = mapper or DEFAULT_MAPPER
+    try:
+        header = await reader.readexactly(4)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise BsonNotEnoughDataError from None
+    size = struct.unpack('<i', header)[0]
+    if size < 5:
+        raise BsonIncorrectSizeError
+    if size > max_document_size:
+        raise BsonDocumentSizeLimitError
+    try:
+        data = header + await reader.readexactly(size - 4)
+    except asyncio.IncompleteReadError:
+        raise BsonNotEnoughDataError from None
+    validate(data, mapper.python_only)
+    return mapper.unmarshal(data)
+
+
+async def write_document(writer: asyncio.StreamWriter, doc: Any, mapper: Mapper | None = None) -> None:
+    writer.write((mapper or DEFAULT_MAPPER).marshal(doc))
+    await writer.drain()
+
+
+class BsonProtocol(asyncio.BufferedProtocol):
+    # Транспорт пишет прямо в свободный хвост одного приемного буфера, готовые документы
+    # декодируются по смещениям без копирования, остаток сдвигается в начало. Буфер растет,
+    # только если не вмещает один документ. Принятые документы по умолчанию кладутся в очередь,
+    # ошибка разбора кладется туда же и закрывает соединение
+    def __init__(self, mapper: Mapper | None = None, buffer_size: int = RECV_BUFFER,
+                 max_document_size: int = MAX_DOCUMENT_SIZE) -> None:
+        self.mapper = mapper or DEFAULT_MAPPER
+        self.max_document_size = max_document_size
+        self.transport: asyncio.Transport | None = None
+        self.queue: asyncio.Queue[Any] = asyncio.Queue()
+        self._buf = bytearray(buffer_size)
+        self._end = 0
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport  # type: ignore[assignment]
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self.queue.put_nowait(exc)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._end == len(self._buf):
+            self._grow(2 * len(self._buf))
+        return memoryview(self._buf)[self._end:]
+
+    def _grow(self, size: int) -> None:
+        # Новый буфер вместо resize: старый может быть еще занят memoryview транспорта
+        buf = bytearray(size)
+        buf[:self._end] = self._buf[:self._end]
+        self._buf = buf
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._end += nbytes
+        data = self._buf
+        pos = 0
+        need = 0
+        try:
+            with memoryview(data) as view:
+                while self._end - pos >= 4:
+                    size = struct.unpack_from('<i', view, pos)[0]
+                    if size < 5:
+                        raise BsonIncorrectSizeError
+                    if size > self.max_document_size:
+                        raise BsonDocumentSizeLimitError
+                    if self._end - pos < size:
+                        need = size
+                        break
+                    validate(data, self.mapper.python_only, pos, pos + size)
+                    doc = self.mapper.unmarshal_at(data, view, pos, pos + size)
+                    pos += size
+                    self.document_received(doc)
+        except BsonError as e:
+            self.queue.put_nowait(e)
+            assert self.transport is not None
+            self.transport.abort()
+            return
+        if pos:
+            data[:self._end - pos] = data[pos:self._end]
+            self._end -= pos
+        if need > len(self._buf):
+            self._grow(need)
+
+    def document_received(self, doc: Dict[Any, Any]) -> None:
+        self.queue.put_nowait(doc)
+
+    def send(self, doc: Any) -> None:
+        assert self.transport is not None
+        self.transport.write(self.mapper.marshal(doc))
+
+    async def recv(self) -> Dict[Any, Any] | None:
+        # None - соединение закрыто
+        item = await self.queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
 
 '''
 #print(struct.unpack('=B', b'1'))
@@ -314,4 +2527,4 @@ d = marshal(g)
 print(datetime(1970, 1, 1, tzinfo=timezone.utc))
 #print(bytes([3, 87]))
 print(unmarshal(d))
-#print(f.marshal(d))'''
\ No newline at end of file
+#print(f.marshal(d))'''
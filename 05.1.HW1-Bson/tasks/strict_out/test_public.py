@@ -1,9 +1,20 @@
+import asyncio
+import bisect
 import bson
+import collections
+import dataclasses
+import enum
+import io
+import mmap
 import pytest
 import random
 import string
+import struct
+import sys
+import typing
 from typing import Any, Dict
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 def test_marshal_dict_empty() -> None:
     inout_test(
@@ -683,6 +694,969 @@ def test_marshal_pseudo_cycle_map() -> None:
 
 
 
+def test_round_datetime_far_from_epoch() -> None:
+    for d in (
+        datetime(2024, 5, 17, 12, 30, 45, 123000, tzinfo=timezone.utc),
+        datetime(1901, 1, 1, 0, 0, 0, 1000, tzinfo=timezone.utc),
+    ):
+        round_dict_test({"k": d})
+
+
+def test_round_big_nested() -> None:
+    round_dict_test({"d": {"s": "x" * 1000, "l": list(range(300))}})
+
+
+def test_unmarshal_bytes_like() -> None:
+    data = {"k": "value", "n": {"f": 1.5, "b": b"\x00\x01"}}
+    blob = bson.marshal(data)
+    for inp in (bytearray(blob), memoryview(blob)):
+        assert bson.unmarshal(inp) == data
+
+
+def test_iter_documents() -> None:
+    docs = [{"i": i, "s": "x" * i, "l": [i] * i} for i in range(20)]
+    stream = io.BytesIO(b"".join(bson.marshal(d) for d in docs))
+    assert list(bson.iter_documents(stream)) == docs
+    assert list(bson.iter_documents(io.BytesIO(b""))) == []
+
+
+def test_iter_documents_truncated() -> None:
+    blob = bson.marshal({"k": "value"})
+    with pytest.raises(bson.BsonNotEnoughDataError):
+        list(bson.iter_documents(io.BytesIO(blob + blob[:-1])))
+    with pytest.raises(bson.BsonNotEnoughDataError):
+        list(bson.iter_documents(io.BytesIO(blob[:2])))
+
+
+# {"s": строка с длиной -7, "x": 1}: skip_element не должен возвращаться назад
+NEGATIVE_STRING = (struct.pack("<i", 22) + b"\x02s\x00" + struct.pack("<i", -7) + b"ab\x00"
+                   + b"\x10x\x00" + struct.pack("<i", 1) + b"\x00")
+
+
+def test_lazy_document() -> None:
+    data = {
+        "s": "hello", "f": 1.5, "i": 7, "b": True, "n": None, "bin": b"\x01",
+        "d": {"x": {"y": [1, 2, 3]}}, "l": ["a", {"k": 1}],
+        "dt": datetime(2020, 1, 1, tzinfo=timezone.utc),
+    }
+    lazy = bson.LazyDocument(bson.marshal(data))
+    assert len(lazy) == len(data)
+    assert list(lazy) == sorted(data)
+    assert "d" in lazy and "zzz" not in lazy
+    assert lazy["d"]["x"]["y"] == [1, 2, 3]
+    assert lazy == data
+    with pytest.raises(KeyError):
+        lazy["zzz"]
+
+
+def test_lazy_document_untouched_not_decoded() -> None:
+    blob = bytearray(bson.marshal({"bad": "ab", "good": 1}))
+    blob[blob.index(b"ab")] = 0xff
+    lazy = bson.LazyDocument(blob)
+    assert lazy["good"] == 1
+    with pytest.raises(ValueError):
+        lazy["bad"]
+
+    # Испорченный размер пропускаемого значения - ошибка, а не бесконечный цикл
+    for broken in (NEGATIVE_STRING, bytearray(NEGATIVE_STRING[:-1] + b"\x01")):
+        with pytest.raises(bson.BsonBrokenDataError):
+            bson.LazyDocument(broken)["x"]
+
+
+def test_mapper_options() -> None:
+    assert not bson.Mapper().python_only
+    m = bson.Mapper(python_only=True)
+    assert m.python_only is True
+    with pytest.raises(AttributeError):
+        m.python_only = False # type: ignore
+    with pytest.raises(AttributeError):
+        del m.python_only
+    with pytest.raises(bson.MapperConfigError):
+        bson.Mapper(something=True)
+    with pytest.raises(TypeError):
+        bson.Mapper(*[True])
+
+
+def test_mapper_subclass_values() -> None:
+    class Color(enum.IntEnum):
+        RED = 1
+
+    class Name(str):
+        pass
+
+    data = {"c": Color.RED, "n": Name("vasya"), "o": collections.OrderedDict(b=1, a=2)}
+    for mapper in (bson, bson.Mapper()):
+        inout_test(inp=data, exp=bson.marshal({"c": 1, "n": "vasya", "o": {"a": 2, "b": 1}}), mapper=mapper)
+        round_dict_with_mapper_test({"c": Color.RED})
+
+
+class Point(typing.NamedTuple):
+    y: int
+    x: float = 0.5
+
+
+@dataclasses.dataclass
+class Row:
+    name: str
+    point: Point
+    tags: list[str] = dataclasses.field(default_factory=list)
+
+
+def test_marshal_namedtuple_and_dataclass() -> None:
+    inout_test(
+        inp={"p": Point(1)},
+        exp=bytes([31, 0, 0, 0, 3, 112, 0, 23, 0, 0, 0, 16, 121, 0, 1, 0, 0, 0,
+                   1, 120, 0, 0, 0, 0, 0, 0, 0, 0xe0, 0x3f, 0, 0]),
+    )
+    row = Row("vasya", Point(2, 1.0), ["a"])
+    assert bson.marshal(row) == bson.Mapper().marshal(row)
+    assert list(bson.unmarshal(bson.marshal(row))) == ["name", "point", "tags"]
+    assert list(bson.unmarshal(bson.marshal(row))["point"]) == ["y", "x"]
+    assert bson.unmarshal(bson.marshal({"rows": [row, row]})) == {
+        "rows": [{"name": "vasya", "point": {"y": 2, "x": 1.0}, "tags": ["a"]}] * 2,
+    }
+
+
+def test_marshal_dataclass_unsupported_field() -> None:
+    with pytest.raises(bson.BsonUnsupportedObjectError):
+        bson.marshal({"r": Row("vasya", Point(1), [object()])})  # type: ignore[list-item]
+    with pytest.raises(bson.BsonUnsupportedObjectError):
+        bson.marshal(Point(object()))  # type: ignore[arg-type]
+
+
+def test_marshal_many(monkeypatch: Any) -> None:
+    docs = [{"i": i, "s": str(i) * (i % 7), "l": [i, None]} for i in range(1000)]
+    blobs = [bson.marshal(d) for d in docs]
+    for mapper in (bson.Mapper(), bson.Mapper(python_only=True)):
+        for workers in (1, 2):
+            assert mapper.marshal_many(iter(docs), workers=workers) == blobs
+            assert mapper.unmarshal_many(blobs, workers=workers) == docs
+
+    # Пачки по CHUNK_MIN_ITEMS: результаты многих пачек должны собраться в исходном порядке
+    monkeypatch.setattr(bson, "CHUNK_BYTES", 100)
+    assert bson.Mapper().marshal_many(docs, workers=2) == blobs
+    assert bson.Mapper().unmarshal_many(blobs, workers=3) == docs
+    assert bson.Mapper().marshal_many([], workers=2) == []
+    with pytest.raises(bson.BsonUnsupportedObjectError):
+        bson.Mapper().marshal_many(docs + [{"k": object()}], workers=2)
+
+    kept = [{"t": (i, "x"), "p": Point(i)} for i in range(100)]
+    mapper = bson.Mapper(keep_types=True)
+    assert mapper.unmarshal_many(mapper.marshal_many(kept, workers=2), workers=2) == kept
+
+
+def test_marshal_deep_nesting() -> None:
+    depth = 100000
+    data: Dict[str, Any] = {}
+    for i in range(depth):
+        data = {"k": data} if i % 2 else {"k": [data]}
+    blob = bson.marshal(data)
+    assert len(blob) == int.from_bytes(blob[:4], "little")
+    assert blob[-depth:] == bytes(depth)
+
+
+def test_marshal_cycle_deep() -> None:
+    data: Dict[str, Any] = {}
+    inner = data
+    for i in range(10000):
+        inner["k"] = {}
+        inner = inner["k"]
+    inner["loop"] = (1, [data])
+    with pytest.raises(bson.BsonCycleDetectedError):
+        bson.marshal(data)
+
+
+def test_mapped_collection_keep_types(tmp_path: Any) -> None:
+    # Метаданные внутри массива разбираются и поверх mmap
+    docs = [{"a": [(1, 2)]}, {"a": [bytearray(b"x"), (3,)], "b": ()}]
+    path = tmp_path / "typed.bson"
+    for m in (bson.Mapper(keep_types=True), bson.Mapper()):
+        path.write_bytes(b"".join(bson.Mapper(keep_types=True).marshal(d) for d in docs))
+        with bson.MappedCollection(path, mapper=m) as coll:
+            assert list(coll) == [m.unmarshal(bson.Mapper(keep_types=True).marshal(d)) for d in docs]
+    with bson.MappedCollection(path, mapper=bson.Mapper(keep_types=True)) as coll:
+        assert coll[0] == docs[0] and type(coll[1]["a"][0]) is bytearray
+
+
+def test_mapped_collection(tmp_path: Any) -> None:
+    docs = [{"i": i, "s": "x" * i, "d": {"l": [i, None]}} for i in range(50)]
+    path = tmp_path / "docs.bson"
+    path.write_bytes(b"".join(bson.marshal(d) for d in docs))
+    with bson.MappedCollection(path) as coll:
+        assert len(coll) == 50
+        assert coll[0] == docs[0]
+        assert coll[-1] == docs[-1]
+        assert coll[10:20:3] == docs[10:20:3]
+        assert list(coll) == docs
+        with pytest.raises(IndexError):
+            coll[50]
+    assert (tmp_path / "docs.bson.idx").exists()
+    with bson.MappedCollection(path) as coll:
+        assert coll[7] == docs[7]
+
+    # Индекс, обрезанный при прерванной записи, не используется
+    index = tmp_path / "docs.bson.idx"
+    index.write_bytes(index.read_bytes()[:8 * 30])
+    with bson.MappedCollection(path) as coll:
+        assert len(coll) == 50 and coll[49] == docs[49]
+    assert sorted(tmp_path.iterdir()) == sorted([path, index])
+
+    path.write_bytes(bson.marshal(docs[0]))
+    with bson.MappedCollection(path) as coll:
+        assert list(coll) == docs[:1]
+
+
+def test_mapped_collection_empty_and_truncated(tmp_path: Any) -> None:
+    path = tmp_path / "docs.bson"
+    path.write_bytes(b"")
+    with bson.MappedCollection(path, persist_index=False) as coll:
+        assert len(coll) == 0
+    path.write_bytes(bson.marshal({"k": 1})[:-1])
+    with pytest.raises(bson.BsonNotEnoughDataError):
+        bson.MappedCollection(path)
+
+
+def test_unmarshal_fields() -> None:
+    data = {
+        "user": {"name": "vasya", "address": {"city": "Moscow", "street": "Lenina"}, "tags": ["a", "b"]},
+        "blob": b"\x00" * 1000,
+        "items": [{"x": 1, "y": 2}, {"x": 3}],
+        "n": 5,
+    }
+    blob = bson.marshal(data)
+    m = bson.Mapper()
+    assert m.unmarshal(blob, fields=["user.address.city"]) == {"user": {"address": {"city": "Moscow"}}}
+    assert m.unmarshal(blob, fields=["n", "user.name", "user.tags"]) == {
+        "n": 5, "user": {"name": "vasya", "tags": ["a", "b"]},
+    }
+    assert m.unmarshal(blob, fields=["items.1.x"]) == {"items": [None, {"x": 3}]}
+    assert m.unmarshal(blob, fields=["items.0.y"]) == {"items": [{"y": 2}]}
+    assert m.unmarshal(blob, fields=["user.tags.1", "items.1"]) == {
+        "user": {"tags": [None, "b"]}, "items": [None, {"x": 3}],
+    }
+    assert m.unmarshal(blob, fields=["user", "user.name"]) == {"user": data["user"]}
+    assert m.unmarshal(blob, fields=["user.name", "user"]) == {"user": data["user"]}
+    assert m.unmarshal(blob, fields=["missing", "n.deeper"]) == {}
+    assert m.unmarshal(blob, fields=[]) == {}
+    # Родитель, в котором не нашлось ни одного запрошенного пути, в результат не попадает
+    for path in ("items.x", "user.zz", "user.tags.5", "n.deeper", "user.address.city.x"):
+        assert m.unmarshal(blob, fields=[path, "n"]) == {"n": 5}
+    with pytest.raises(bson.BsonBadArrayIndexError):
+        m.unmarshal(bson.marshal({"a": {"²": 1}}).replace(b"\x03a", b"\x04a"), fields=["a.²"])
+    with pytest.raises(bson.BsonBrokenDataError):
+        m.unmarshal(NEGATIVE_STRING, fields=["x"])
+
+
+def test_validate_accepts() -> None:
+    data = {"a": [1, 2 ** 40, [None, True]], "s": "привет", "b": b"\x00\x01", "d": {"x": 0.5}}
+    blob = bson.marshal(data)
+    mapped = mmap.mmap(-1, len(blob))
+    mapped.write(blob)
+    for m in (bson.validate, lambda b: bson.validate(b, python_only=True)):
+        m(blob)
+        m(bytearray(blob))
+        m(mapped)
+    repeated = mmap.mmap(-1, 11)
+    repeated.write(bytes([11, 0, 0, 0, 10, 97, 0, 10, 97, 0, 0]))
+    with pytest.raises(bson.BsonRepeatedKeyDataError):
+        bson.validate(repeated)
+    # не наши типы и подтипы допустимы только без python_only
+    foreign = [
+        [20, 0, 0, 0, 7, ord('a'), 0] + [255] * 12 + [0],
+        [13, 0, 0, 0, 5, 0, 1, 0, 0, 0, 200, 0x55, 0],
+        [11, 0, 0, 0, 11, 0, 100, 0, 100, 0, 0],
+        [22, 0, 0, 0, 15, 107, 0, 14, 0, 0, 0, 1, 0, 0, 0, 0, 5, 0, 0, 0, 0, 0],
+        [26, 0, 0, 0, 4, 0, 19, 0, 0, 0, 16, 49, 0, 1, 0, 0, 0, 16, 48, 0, 1, 0, 0, 0, 0, 0],
+    ]
+    for d in foreign:
+        bson.validate(bytes(d))
+        with pytest.raises(bson.BsonBrokenDataError):
+            bson.validate(bytes(d), python_only=True)
+
+
+def test_validate_errors() -> None:
+    cases = [
+        ([5, 0, 0], bson.BsonBrokenDataError),
+        ([4, 0, 0, 0], bson.BsonIncorrectSizeError),
+        ([5, 0, 0, 0, 0, 0], bson.BsonTooManyDataError),
+        ([6, 0, 0, 0, 0], bson.BsonNotEnoughDataError),
+        ([5, 0, 0, 0, 1], bson.BsonBrokenDataError),
+        ([6, 0, 0, 0, 10, 0], bson.BsonBrokenDataError),
+        ([8, 0, 0, 0, 10, 200, 0, 0], bson.BsonBadKeyDataError),
+        ([8, 0, 0, 0, 20, 97, 0, 0], bson.BsonInvalidElementTypeError),
+        ([12, 0, 0, 0, 6, 100, 0, 8, 100, 0, 1, 0], bson.BsonRepeatedKeyDataError),
+        ([13, 0, 0, 0, 2, 113, 0, 0, 0, 0, 0, 0, 0], bson.BsonStringSizeError),
+        ([14, 0, 0, 0, 2, 0, 4, 0, 0, 0, 100, 100, 0, 0], bson.BsonInconsistentStringSizeError),
+        ([13, 0, 0, 0, 2, 0, 2, 0, 0, 0, 200, 0, 0], bson.BsonBadStringDataError),
+        ([14, 0, 0, 0, 2, 97, 98, 0, 1, 0, 0, 0, 1, 0], bson.BsonBrokenDataError),
+        ([12, 0, 0, 0, 3, 0, 5, 0, 0, 0, 1, 0], bson.BsonBrokenDataError),
+        ([12, 0, 0, 0, 3, 0, 4, 0, 0, 0, 0, 0], bson.BsonIncorrectSizeError),
+        ([12, 0, 0, 0, 5, 0, 0, 0, 0, 0, 10, 0], bson.BsonInvalidBinarySubtypeError),
+        ([21, 0, 0, 0, 19, 0] + [0] * 14 + [0], bson.BsonBrokenDataError),
+        ([15, 0, 0, 0, 4, 0, 8, 0, 0, 0, 10, 100, 0, 0, 0], bson.BsonBadArrayIndexError),
+        ([20, 0, 0, 0, 4, 0, 13, 0, 0, 0, 16, 48, 50, 0, 123, 0, 0, 0, 0, 0], bson.BsonBadArrayIndexError),
+        ([29, 0, 0, 0, 4, 0, 22, 0, 0, 0, 6, 48, 0, 16, 49, 0, 32, 0, 0, 0, 16, 48, 0, 32, 0, 0, 0, 0, 0],
+         bson.BsonRepeatedKeyDataError),
+        ([25, 0, 0, 0, 3, 0, 18, 0, 0, 0, 6, 0, 3, 0, 5, 0, 0, 0, 0, 6, 0, 0, 0, 0, 0],
+         bson.BsonRepeatedKeyDataError),
+    ]
+    for d, exc in cases:
+        for python_only in (False, True):
+            with pytest.raises(exc):
+                bson.validate(bytes(d), python_only=python_only)
+    with pytest.raises(bson.BsonBadStringDataError):
+        bson.validate(bytes([11, 0, 0, 0, 11, 0, 200, 0, 100, 0, 0]))
+
+
+def test_unmarshal_negative_sizes() -> None:
+    # Без предварительной проверки отрицательный размер уводил разбор назад, и unmarshal зацикливался
+    tail = b"\x10x\x00" + struct.pack("<i", 1)
+    cases = [
+        (b"\x05b\x00" + struct.pack("<i", -6) + b"\x00", bson.BsonBrokenDataError),
+        (b"\x03d\x00" + struct.pack("<i", -4), bson.BsonIncorrectSizeError),
+        (b"\x04l\x00" + struct.pack("<i", 3), bson.BsonIncorrectSizeError),
+        (b"\x05__metadata__\x00" + struct.pack("<i", -9) + b"\x80", bson.BsonBrokenDataError),
+    ]
+    blobs: list[tuple[bytes, type[bson.BsonBrokenDataError]]] = [(NEGATIVE_STRING, bson.BsonStringSizeError)]
+    blobs += [(struct.pack("<i", len(body) + len(tail) + 5) + body + tail + b"\x00", exc) for body, exc in cases]
+    for blob, exc in blobs:
+        for mapper in (bson.DEFAULT_MAPPER, bson.Mapper(keep_types=True)):
+            with pytest.raises(exc):
+                mapper.unmarshal(blob)
+    with pytest.raises(bson.BsonIncorrectSizeError):
+        bson.unmarshal(bson.marshal({"l": [[1]]}).replace(b"\x0c\x00\x00\x00\x100", b"\x02\x00\x00\x00\x100"))
+
+
+def test_validate_python_only_array() -> None:
+    hole = bytes([19, 0, 0, 0, 4, 0, 12, 0, 0, 0, 16, 49, 0, 123, 0, 0, 0, 0, 0])
+    bson.validate(hole)
+    with pytest.raises(bson.BsonInvalidArrayError):
+        bson.validate(hole, python_only=True)
+    repeated = bytes([26, 0, 0, 0, 4, 0, 19, 0, 0, 0, 16, 48, 0, 32, 0, 0, 0, 16, 48, 0, 32, 0, 0, 0, 0, 0])
+    for python_only in (False, True):
+        with pytest.raises(bson.BsonRepeatedKeyDataError):
+            bson.validate(repeated, python_only=python_only)
+    deep: Dict[str, Any] = {}
+    cur = deep
+    for _ in range(10000):
+        cur["a"] = {}
+        cur = cur["a"]
+    bson.validate(bson.marshal(deep), python_only=True)
+
+
+def test_key_table_shares_keys() -> None:
+    table = bson.KEY_TABLE
+    table.clear()
+    blob = bson.marshal({"long_key_name": 1, "nested": {"long_key_name": 2}})
+    first = bson.unmarshal(blob)
+    second = bson.unmarshal(bytearray(blob))
+    k1 = next(iter(first))
+    k2 = next(iter(second))
+    assert k1 == k2 == "long_key_name" and k1 is k2
+    assert table.stats() == {"size": 2, "hits": 4, "misses": 2}
+
+    small = bson.KeyTable(limit=2)
+    for raw in (b"a", b"b", b"c"):
+        small.add(raw)
+    assert small.stats() == {"size": 1, "hits": 0, "misses": 3}
+
+
+def test_to_columns() -> None:
+    np = pytest.importorskip("numpy")
+    rows = [
+        {"id": i, "big": 2 ** 40 + i, "x": i / 2, "ok": i % 3 == 0, "name": f"n{i}",
+         "t": datetime(2020, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=i), "sub": {"a": 1}}
+        for i in range(3000)
+    ]
+    rows[5]["x"] = None
+    del rows[7]["name"]
+    buf = b"".join(bson.marshal(r) for r in rows)
+    for source in (buf, bytearray(buf), io.BytesIO(buf)):
+        cols = bson.to_columns(source)
+        assert sorted(cols) == ["big", "id", "name", "ok", "t", "x"]
+        assert cols["id"].dtype == np.int64 and list(cols["id"][:3]) == [0, 1, 2]
+        assert cols["big"][-1] == 2 ** 40 + 2999
+        assert cols["x"][4] == 2.0 and np.isnan(cols["x"][5])
+        assert cols["ok"].dtype == np.bool_ and list(cols["ok"][:4]) == [True, False, False, True]
+        assert cols["name"][6] == "n6" and cols["name"][7] is None
+        assert cols["t"][1] == np.datetime64("2020-01-01T00:00:01", "ms")
+    cols = bson.to_columns(buf, schema={"id": float, "name": str})
+    assert list(cols) == ["id", "name"] and cols["id"].dtype == np.float64
+    with pytest.raises(bson.BsonSchemaMismatchError):
+        bson.to_columns(buf, schema={"name": int})
+    with pytest.raises(bson.BsonSchemaMismatchError):
+        bson.to_columns(bson.marshal({"a": 1}) + bson.marshal({"b": 1}), schema={"a": int})
+    with pytest.raises(bson.BsonNotEnoughDataError):
+        bson.to_columns(buf[:-1])
+    # Испорченный размер строки - ошибка и при выводе схемы, и при заполнении колонок
+    schemas: list[dict[str, type] | None] = [None, {"x": int}, {"s": str}]
+    for schema in schemas:
+        with pytest.raises(bson.BsonBrokenDataError):
+            bson.to_columns(bson.marshal({"x": 0}) + NEGATIVE_STRING, schema=schema)
+
+
+def test_to_columns_frame() -> None:
+    pytest.importorskip("pandas")
+    buf = b"".join(bson.marshal({"a": i, "b": str(i)}) for i in range(10))
+    df = bson.to_columns(buf, frame=True)
+    assert list(df.columns) == ["a", "b"] and df["a"].sum() == 45
+
+
+class WriteOnly(io.RawIOBase):
+    def __init__(self) -> None:
+        self.chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: Any) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+
+
+def test_marshal_to(monkeypatch: Any) -> None:
+    data = {"a": [{"x": i, "s": "v" * (i % 7)} for i in range(500)], "b": {"c": b"\x01" * 300}, "d": 1.5}
+    expected = bson.marshal(data)
+    m = bson.Mapper()
+    monkeypatch.setattr(bson.StreamWriter, "limit", 64)
+    out = io.BytesIO(b"head")
+    out.seek(4)
+    assert m.marshal_to(out, data) == len(expected)
+    assert out.getvalue() == b"head" + expected
+
+    # Поток без seek и tell: marshal_to ждет BinaryIO, но должен обходиться одним write
+    stream = WriteOnly()
+    assert m.marshal_to(typing.cast(typing.BinaryIO, stream), data) == len(expected)
+    assert b"".join(stream.chunks) == expected
+
+    out = io.BytesIO()
+    m.marshal_to(out, {"g": (i * i for i in range(3000))})
+    assert bson.unmarshal(out.getvalue()) == {"g": [i * i for i in range(3000)]}
+    # Генераторы принимает только marshal_to
+    with pytest.raises(bson.BsonUnsupportedObjectError):
+        bson.marshal({"g": (i for i in range(3))})
+
+    out = io.BytesIO()
+    out.write(b"keep")
+    with pytest.raises(bson.BsonUnsupportedObjectError):
+        m.marshal_to(out, {"a": list(range(1000)), "z": (x for x in [1, object()])})
+    assert out.getvalue() == b"keep"
+
+
+def test_read_document() -> None:
+    async def scenario() -> None:
+        reader = asyncio.StreamReader()
+        reader.feed_data(bson.marshal({"a": 1}) + bson.marshal({"b": [1, 2]}))
+        reader.feed_eof()
+        assert await bson.read_document(reader) == {"a": 1}
+        assert await bson.read_document(reader) == {"b": [1, 2]}
+        assert await bson.read_document(reader) is None
+
+        reader = asyncio.StreamReader()
+        reader.feed_data(bson.marshal({"a": 1})[:-1])
+        reader.feed_eof()
+        with pytest.raises(bson.BsonNotEnoughDataError):
+            await bson.read_document(reader)
+
+        # Вложенный документ отрицательного размера и размер больше предела
+        reader = asyncio.StreamReader()
+        reader.feed_data(bytes.fromhex("10000000 03 6100 fdffffff 00000000 00"))
+        with pytest.raises(bson.BsonIncorrectSizeError):
+            await bson.read_document(reader)
+        reader = asyncio.StreamReader()
+        reader.feed_data(struct.pack("<i", 2 ** 31 - 1))
+        with pytest.raises(bson.BsonDocumentSizeLimitError):
+            await bson.read_document(reader)
+        reader = asyncio.StreamReader()
+        reader.feed_data(bson.marshal({"s": "x" * 100}))
+        with pytest.raises(bson.BsonDocumentSizeLimitError):
+            await bson.read_document(reader, max_document_size=100)
+
+    asyncio.run(scenario())
+
+
+class FakeTransport(asyncio.Transport):
+    def __init__(self) -> None:
+        super().__init__()
+        self.aborted = False
+
+    def abort(self) -> None:
+        self.aborted = True
+
+
+def feed(protocol: Any, data: bytes, step: int) -> None:
+    for i in range(0, len(data), step):
+        chunk = data[i:i + step]
+        buf = protocol.get_buffer(len(chunk))
+        n = min(len(chunk), len(buf))
+        buf[:n] = chunk[:n]
+        protocol.buffer_updated(n)
+        if n < len(chunk):
+            feed(protocol, chunk[n:], step)
+
+
+def test_bson_protocol() -> None:
+    docs = [{"i": i, "s": "x" * (i * 37 % 500)} for i in range(200)] + [{"big": b"\x01" * 100000}]
+    stream = b"".join(bson.marshal(d) for d in docs)
+    for step in (1, 7, 4096, len(stream)):
+        protocol = bson.BsonProtocol(buffer_size=64)
+        protocol.connection_made(FakeTransport())
+        feed(protocol, stream, step)
+        got = [protocol.queue.get_nowait() for _ in range(protocol.queue.qsize())]
+        assert got == docs
+        assert protocol._end == 0
+
+    protocol = bson.BsonProtocol()
+    transport = FakeTransport()
+    protocol.connection_made(transport)
+    feed(protocol, bytes([4, 0, 0, 0, 0]), 5)
+    assert isinstance(protocol.queue.get_nowait(), bson.BsonIncorrectSizeError)
+    assert transport.aborted
+
+    for frame, exc in [
+        (bytes.fromhex("10000000 03 6100 fdffffff 00000000 00"), bson.BsonIncorrectSizeError),
+        (struct.pack("<i", 2 ** 31 - 1), bson.BsonDocumentSizeLimitError),
+    ]:
+        protocol = bson.BsonProtocol(buffer_size=64)
+        transport = FakeTransport()
+        protocol.connection_made(transport)
+        feed(protocol, frame, len(frame))
+        assert isinstance(protocol.queue.get_nowait(), exc)
+        assert transport.aborted and len(protocol._buf) == 64
+
+
+def test_bson_protocol_echo() -> None:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while (doc := await bson.read_document(reader)) is not None:
+            await bson.write_document(writer, doc)
+        writer.close()
+
+    async def scenario() -> None:
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_connection(bson.BsonProtocol, "127.0.0.1", port)
+        for i in range(20):
+            protocol.send({"n": i, "pad": "y" * i * 1000})
+            assert await protocol.recv() == {"n": i, "pad": "y" * i * 1000}
+        transport.close()
+        assert await protocol.recv() is None
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_array_decoding_python_only() -> None:
+    blob = bson.marshal({"ts": [i * 0.5 for i in range(1000)], "n": [[1, 2], []]})
+    for m in (bson.Mapper(), bson.Mapper(python_only=True)):
+        assert m.unmarshal(blob) == {"ts": [i * 0.5 for i in range(1000)], "n": [[1, 2], []]}
+    # "Дырки" в индексах заполняются None, в python_only это ошибка
+    hole = bytes([19, 0, 0, 0, 4, 0, 12, 0, 0, 0, 16, 49, 0, 123, 0, 0, 0, 0, 0])
+    assert bson.Mapper().unmarshal(hole) == {"": [None, 123]}
+    with pytest.raises(bson.BsonInvalidArrayError):
+        bson.Mapper(python_only=True).unmarshal(hole)
+    # Индексы 2, 0: ноль встает на место дырки
+    unordered = bytes([26, 0, 0, 0, 4, 0, 19, 0, 0, 0, 16, 50, 0, 2, 0, 0, 0, 16, 48, 0, 7, 0, 0, 0, 0, 0])
+    assert bson.Mapper().unmarshal(unordered) == {"": [7, None, 2]}
+    with pytest.raises(bson.BsonInvalidArrayError):
+        bson.Mapper(python_only=True).unmarshal(unordered)
+    repeated = bytes([26, 0, 0, 0, 4, 0, 19, 0, 0, 0, 16, 48, 0, 2, 0, 0, 0, 16, 48, 0, 7, 0, 0, 0, 0, 0])
+    for m in (bson.Mapper(), bson.Mapper(python_only=True)):
+        with pytest.raises(bson.BsonRepeatedKeyDataError):
+            m.unmarshal(repeated)
+    bad_index = bytes([19, 0, 0, 0, 4, 0, 12, 0, 0, 0, 16, 120, 0, 123, 0, 0, 0, 0, 0])
+    with pytest.raises(bson.BsonBadArrayIndexError):
+        bson.Mapper().unmarshal(bad_index)
+    huge = bytes([29, 0, 0, 0, 4, 0, 22, 0, 0, 0, 16]) + b"99999999999\x00" + bytes([1, 0, 0, 0, 0, 0])
+    with pytest.raises(bson.BsonInvalidArrayError):
+        bson.Mapper().unmarshal(huge)
+    with pytest.raises(bson.BsonInvalidBinarySubtypeError):
+        bson.Mapper(python_only=True).unmarshal(bytes([13, 0, 0, 0, 5, 0, 1, 0, 0, 0, 2, 0x55, 0]))
+    with pytest.raises(bson.BsonInvalidElementTypeError):
+        bson.Mapper(python_only=True).unmarshal(bytes([20, 0, 0, 0, 7, ord('a'), 0] + [0] * 12 + [0]))
+
+
+def test_index_names(monkeypatch: Any) -> None:
+    limit = 1 << 10
+    monkeypatch.setattr(bson, "ARRAY_KEYS_LIMIT", limit)
+    monkeypatch.setattr(bson, "ARRAY_KEYS", [])
+    assert list(bson.index_names(0, 3))[:3] == [b"0\x00", b"1\x00", b"2\x00"]
+    assert list(bson.index_names(limit - 1, limit + 2)) == [b"%d\x00" % i for i in range(limit - 1, limit + 2)]
+    assert list(bson.index_names(limit + 5, limit + 7)) == [b"%d\x00" % (limit + 5), b"%d\x00" % (limit + 6)]
+    assert len(bson.ARRAY_KEYS) == limit
+    data = {"a": list(range(limit + 10))}
+    assert bson.unmarshal(bson.marshal(data)) == data
+
+
+def test_index_names_threads(monkeypatch: Any) -> None:
+    # Частое переключение потоков, чтобы расширения таблицы пересекались
+    monkeypatch.setattr(bson, "ARRAY_KEYS", [])
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        sizes = [random.randint(1, 20000) for _ in range(200)]
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda n: list(bson.index_names(0, n)[:n]), sizes))
+    finally:
+        sys.setswitchinterval(interval)
+    for n, names in zip(sizes, results):
+        assert names == [b"%d\x00" % i for i in range(n)]
+    assert bson.ARRAY_KEYS == [b"%d\x00" % i for i in range(max(sizes))]
+
+
+def test_shape_cache() -> None:
+    m = bson.Mapper()
+    for i in range(10):
+        assert m.marshal({"b": i, "a": "x"}) == bson.marshal({"a": "x", "b": i})
+    m.marshal({"a": "x", "b": 1})
+    stats = m.shape_cache.stats()
+    assert stats["size"] == 2 and stats["misses"] == 2 and stats["hits"] == 9
+    assert stats["hit_rate"] == pytest.approx(9 / 11)
+    with pytest.raises(bson.BsonKeyWithZeroByteError):
+        m.marshal({"b": 1, "a\x00": 2})
+    with pytest.raises(bson.BsonKeyWithZeroByteError):
+        m.marshal({"b": 1, "a\x00": 2})
+
+    cache = bson.ShapeCache(limit=2)
+    cache.add(("a",), ["a"])
+    cache.add(("b",), ["b"])
+    assert cache.get(("a",)) == (["a"], [b"a\x00"])
+    cache.add(("c",), ["c"])
+    assert cache.get(("b",)) is None and cache.get(("a",)) is not None
+    cache.clear()
+    assert cache.stats() == {"size": 0, "keys": 0, "hits": 0, "misses": 0, "hit_rate": 0.0}
+
+    # Бюджет - суммарное число ключей: широкая форма вытесняет старые, а шире бюджета не кэшируется
+    cache = bson.ShapeCache(keys_limit=5)
+    cache.add(("a", "b"), ["a", "b"])
+    cache.add(("c", "d"), ["c", "d"])
+    cache.add(("e", "f", "g"), ["e", "f", "g"])
+    assert cache.get(("a", "b")) is None and cache.get(("c", "d")) is not None
+    assert cache.stats()["keys"] == 5
+    cache.add(tuple("uvwxyz"), list("uvwxyz"))
+    assert cache.get(tuple("uvwxyz")) is None and cache.stats()["size"] == 2
+
+    m.shape_cache.clear()
+    wide = {"k%d" % i: float(i) for i in range(100)}
+    assert m.unmarshal(m.marshal(wide)) == wide
+    assert m.shape_cache.stats()["keys"] == 100
+    big = {"k%d" % i: i for i in range(bson.SHAPE_CACHE_KEYS + 1)}
+    m.shape_cache.clear()
+    assert m.unmarshal(m.marshal(big)) == big
+    assert m.shape_cache.stats()["size"] == 0
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_numeric_arrays(numpy: bool, monkeypatch: Any) -> None:
+    from array import array
+    if not numpy:
+        monkeypatch.setattr(bson, "np", None)
+    elif bson.np is None:
+        pytest.skip("numpy is not installed")
+    for n in (0, 1, 10, 11, 1234):
+        floats = [i / 7 for i in range(n)]
+        ints = [i * (-1) ** i for i in range(n)]
+        assert bson.marshal({"a": array("d", floats)}) == bson.marshal({"a": floats})
+        assert bson.marshal({"a": array("i", ints)}) == bson.marshal({"a": ints})
+        assert bson.unmarshal(bson.marshal({"a": array("q", ints)})) == {"a": ints}
+        assert bson.unmarshal(bson.marshal({"a": array("h", ints)})) == {"a": ints}
+
+        m = bson.Mapper(arrays="array")
+        got = m.unmarshal(bson.marshal({"f": floats, "i": ints, "q": array("q", ints), "mixed": [1, 1.5]}))
+        if n:
+            assert got["f"] == array("d", floats) and got["i"] == array("i", ints) and got["q"] == array("q", ints)
+        else:
+            assert got["f"] == got["i"] == got["q"] == []
+        assert got["mixed"] == [1, 1.5]
+    holes = bytes([19, 0, 0, 0, 4, 0, 12, 0, 0, 0, 16, 49, 0, 123, 0, 0, 0, 0, 0])
+    assert bson.Mapper(arrays="array").unmarshal(holes) == {"": [None, 123]}
+    with pytest.raises(bson.MapperConfigError):
+        bson.Mapper(arrays="tuple")
+
+
+def test_numeric_arrays_numpy() -> None:
+    np = pytest.importorskip("numpy")
+    values = np.arange(1500, dtype=np.float64) / 3
+    blob = bson.marshal({"v": values, "i": np.arange(5, dtype=np.int32), "m": np.ones((2, 2))})
+    assert blob == bson.marshal({"v": values.tolist(), "i": list(range(5)), "m": [[1.0, 1.0], [1.0, 1.0]]})
+    assert bson.marshal({"v": values[::2]}) == bson.marshal({"v": values[::2].tolist()})
+    got = bson.Mapper(arrays="numpy").unmarshal(blob)
+    assert got["v"].dtype == np.float64 and np.array_equal(got["v"], values)
+    assert got["i"].dtype == np.int32 and list(got["i"]) == list(range(5))
+    assert all(isinstance(row, np.ndarray) for row in got["m"])
+    assert bson.Mapper(arrays="numpy").unmarshal(bson.marshal({"e": [], "s": ["a"]})) == {"e": [], "s": ["a"]}
+    # Многомерный datetime64 пишется построчно, как и одномерный - в миллисекундах UTC
+    stamps = np.array([["2020-01-01T00:00:00.001", "1969-12-31T23:59:59.999"], ["1970-01-01", "2000-02-29T12:00"]],
+                      "datetime64[ns]")
+    assert bson.unmarshal(bson.marshal({"t": stamps})) == {"t": [bson.unmarshal(bson.marshal({"r": row}))["r"]
+                                                                 for row in stamps]}
+    assert bson.unmarshal(bson.marshal({"t": stamps}))["t"][1] == [
+        datetime(1970, 1, 1, tzinfo=timezone.utc), datetime(2000, 2, 29, 12, tzinfo=timezone.utc)]
+    with pytest.raises(bson.BsonUnsupportedObjectError):
+        bson.marshal({"x": np.array(1.5)})
+
+
+
+def test_keep_types_markers() -> None:
+    m = bson.Mapper(keep_types=True)
+    data = {"ea2": (), "ea1": (123,), "b": bytearray(b"x")}
+    inout_test(
+        inp={"ea2": (), "ea1": (123,)},
+        exp=bytes([62, 0, 0, 0,
+                   4, 101, 97, 49, 0, 12, 0, 0, 0, 16, 48, 0, 123, 0, 0, 0, 0, 4, 101, 97, 50, 0, 5, 0, 0, 0, 0,
+                   5, 95, 95, 109, 101, 116, 97, 100, 97, 116, 97, 95, 95, 0, 11, 0, 0, 0, 128,
+                   116, 117, 112, 108, 101, 58, 116, 117, 112, 108, 101, 0]),
+        mapper=m,
+    )
+    assert m.marshal({"a": [1, "x"], "b": b""}) == bson.marshal({"a": [1, "x"], "b": b""})
+    for mapper in (m, bson.Mapper(keep_types=True, python_only=True)):
+        assert mapper.unmarshal(m.marshal(data)) == data
+        assert type(mapper.unmarshal(m.marshal(data))["b"]) is bytearray
+    # Без keep_types метаданные пропускаются, в том числе в python_only
+    for unmarshal in (bson.unmarshal, bson.Mapper(python_only=True).unmarshal):
+        assert unmarshal(m.marshal(data)) == {"ea2": [], "ea1": [123], "b": b"x"}
+        assert unmarshal(m.marshal({"__metadata__": ()})) == {"__metadata__": []}
+    out = io.BytesIO()
+    m.marshal_to(out, {"__metadata__": (), "g": (x for x in [(), 1])})
+    assert m.unmarshal(out.getvalue()) == {"__metadata__": (), "g": [(), 1]}
+    assert m.keep_types and not bson.Mapper().keep_types
+    with pytest.raises(AttributeError):
+        m.keep_types = False # type: ignore
+
+
+@dataclasses.dataclass
+class Sample:
+    t: typing.Annotated[int, {"unit": "ms"}]
+    v: int = 0
+
+
+def test_unhashable_annotations() -> None:
+    # Описание класса для keep_types строится только при keep_types, а нехешируемая аннотация - это 'any'
+    assert bson.unmarshal(bson.marshal({"s": Sample(5)})) == {"s": {"t": 5, "v": 0}}
+    m = bson.Mapper(keep_types=True)
+    restored = m.unmarshal(m.marshal({"s": Sample(5, 1)}))["s"]
+    assert (restored.t, restored.v) == (5, 1)
+    assert dataclasses.fields(restored)[0].type is typing.Any
+
+
+def test_keep_types_classes() -> None:
+    m = bson.Mapper(keep_types=True)
+    row = Row("vasya", Point(2, 1.0), ["a"])
+    data = {"rows": [row, Row("petya", Point(3), [])], "p": Point(1)}
+    result = m.unmarshal(m.marshal(data))
+    assert result["p"] == (1, 0.5) and type(result["p"]) is type(result["rows"][1].point)
+    assert result["p"]._fields == ("y", "x") and result["p"]._field_defaults == {"x": 0.5}
+    assert type(result["rows"][0]) is type(result["rows"][1])
+    assert dataclasses.fields(result["rows"][0])[1].name == "point"
+    assert dataclasses.astuple(result["rows"][0]) == ("vasya", (2, 1.0), ["a"])
+
+    root = m.unmarshal(m.marshal(row))
+    assert type(root).__name__ == "Row" and type(root) is type(result["rows"][0])
+    assert type(m.unmarshal(m.marshal(Point(5)))) is type(result["p"])
+    assert bson.unmarshal(m.marshal(row)) == bson.unmarshal(bson.marshal(row))
+
+
+def test_keep_types_ignored_by_lazy_and_projection() -> None:
+    m = bson.Mapper(keep_types=True)
+    blob = m.marshal({"t": (1, 2), "x": 1, "d": {"p": Point(3)}})
+    lazy = bson.LazyDocument(blob)
+    assert sorted(lazy) == ["d", "t", "x"] and "__metadata__" not in lazy
+    assert lazy["t"] == [1, 2] and dict(lazy["d"]) == {"p": {"y": 3, "x": 0.5}}
+    assert m.unmarshal(blob, fields=["t", "d.p", "__metadata__"]) == {"t": [1, 2], "d": {"p": {"y": 3, "x": 0.5}}}
+    assert m.unmarshal(blob, fields=["x"]) == {"x": 1}
+
+
+def test_keep_types_registry_reuses_classes() -> None:
+    # Разобранные метаданные кэшируются по байтам, иначе реестр не увидит ни одного промаха
+    bson.METADATA_CACHE.clear()
+    bson.TYPE_REGISTRY.clear()
+    m = bson.Mapper(keep_types=True)
+    docs = [m.marshal({"p": Point(i), "t": tuple(range(i % 3))}) for i in range(1000)]
+    classes = {type(bson.Mapper(keep_types=True).unmarshal(doc)["p"]) for doc in docs}
+    assert len(classes) == 1
+    assert bson.TYPE_REGISTRY.stats()["misses"] == 1
+
+
+def test_keep_types_broken_metadata() -> None:
+    m = bson.Mapper(keep_types=True)
+    array = bson.marshal({"a": [1]})[4:-1]
+    for metadata in (b"set", b"tuple:tuple", b"nt-0", b"bytearray"):
+        body = array + b"\x05__metadata__\x00" + len(metadata).to_bytes(4, "little") + b"\x80" + metadata + b"\x00"
+        broken = (len(body) + 4).to_bytes(4, "little") + body
+        with pytest.raises(bson.BsonInvalidMetadataError):
+            m.unmarshal(broken)
+    for params in ({"namespace": {"evil": 1}}, {"slots": True}, {"frozen": 1}, ["frozen"]):
+        description = {"name": "P", "fields": ["a"], "annotations": {"a": "int"}, "params": params}
+        with pytest.raises(bson.BsonInvalidMetadataError):
+            bson.TYPE_REGISTRY.restore("dc", description)
+
+
+def test_datetime_integer_codec() -> None:
+    utc = timezone.utc
+    for d in (datetime(1, 1, 1, tzinfo=utc), datetime(9999, 12, 31, 23, 59, 59, 999000, tzinfo=utc),
+              datetime(2024, 5, 17, 12, 30, 45, 123000, tzinfo=timezone(timedelta(hours=3)))):
+        assert bson.unmarshal(bson.marshal({"d": d})) == {"d": d}
+    # Доли миллисекунды отбрасываются вниз, в том числе до эпохи
+    before_epoch = bson.marshal({"d": datetime(1969, 12, 31, 23, 59, 59, 999500, tzinfo=utc)})
+    assert before_epoch[-9:-1] == (-1).to_bytes(8, "little", signed=True)
+    naive = datetime(2020, 1, 1, 12, 0, 0, 5000)
+    assert bson.unmarshal(bson.marshal({"d": naive}))["d"] == naive.astimezone(utc)
+    # Миллисекунды за пределами datetime - испорченные данные, а не OverflowError
+    for ms in (2 ** 62, -2 ** 63, 253402300800000):
+        blob = bytes([16, 0, 0, 0, 9, ord("d"), 0]) + struct.pack("<q", ms) + bytes([0])
+        for m in (bson.Mapper(), bson.Mapper(python_only=True)):
+            with pytest.raises(bson.BsonDatetimeOutOfRangeError):
+                m.unmarshal(blob)
+
+
+def test_datetime_numpy_arrays() -> None:
+    np = pytest.importorskip("numpy")
+    dates = [datetime(2020, 1, 1, tzinfo=timezone.utc) + timedelta(milliseconds=7 * i) for i in range(1234)]
+    stamps = np.array([d.replace(tzinfo=None) for d in dates], "datetime64[ms]")
+    assert bson.marshal({"t": stamps}) == bson.marshal({"t": dates})
+    assert bson.marshal({"t": stamps.astype("datetime64[us]")}) == bson.marshal({"t": dates})
+    got = bson.Mapper(arrays="numpy").unmarshal(bson.marshal({"t": dates}))["t"]
+    assert got.dtype == np.dtype("datetime64[ms]") and (got == stamps).all()
+    assert bson.Mapper(arrays="array").unmarshal(bson.marshal({"t": stamps})) == {"t": dates}
+
+
+
+def test_patch() -> None:
+    doc = {"user": {"name": "vasya", "tags": ["a", "b", "c"], "age": 30}, "n": 1.5}
+    buf = bytearray(bson.marshal(doc))
+    size = len(buf)
+    assert bson.patch(buf, "user.age", 31) is buf and len(buf) == size
+    doc["user"]["age"] = 31  # type: ignore[index]
+    assert buf == bson.marshal(doc)
+
+    for path, value in (("user.name", "vasilisa"), ("user.tags.1", {"x": [1, 2]}), (["n"], None), ("user", [])):
+        buf = bson.patch(buf, path, value)
+        *parents, last = path.split(".") if isinstance(path, str) else path
+        node: Any = doc
+        for part in parents:
+            node = node[int(part)] if isinstance(node, list) else node[part]
+        if isinstance(node, list):
+            node[int(last)] = value
+        else:
+            node[last] = value
+        assert buf == bson.marshal(doc)
+        assert bson.Mapper(python_only=True).unmarshal(buf) == doc
+
+    patched = bson.patch(bson.marshal({"a": {"b": 1}}), ("a", "b"), "long string")
+    assert type(patched) is bytes and bson.unmarshal(patched) == {"a": {"b": "long string"}}
+
+
+def test_patch_errors() -> None:
+    buf = bytearray(bson.marshal({"a": {"b": 1}, "c": 2}))
+    original = bytes(buf)
+    for path in ("x", "a.x", "c.d", "a.b.c"):
+        with pytest.raises(KeyError):
+            bson.patch(buf, path, 1)
+    with pytest.raises(bson.BsonUnsupportedObjectError):
+        bson.patch(buf, "a.b", object())
+    with pytest.raises(bson.BsonNotEnoughDataError):
+        bson.patch(buf[:-1], "c", 1)
+    assert buf == original
+    # Отрицательная длина строки не должна зацикливать обход
+    with pytest.raises(bson.BsonBrokenDataError):
+        bson.patch(NEGATIVE_STRING, "x", 2)
+
+    # Маркер keep_types в метаданных родителя не должен остаться от замененного значения
+    m = bson.Mapper(keep_types=True)
+    typed = m.marshal({"t": (1, 2), "x": 1, "d": {"l": [Point(1), 2]}})
+    for path in ("t", "d.l.0"):
+        with pytest.raises(bson.BsonPatchTypedValueError):
+            bson.patch(typed, path, 5)
+    patched = bson.patch(bson.patch(typed, "x", 2), "d.l.1", 3)
+    assert m.unmarshal(patched) == {"t": (1, 2), "x": 2, "d": {"l": [Point(1), 3]}}
+    assert m.unmarshal(bson.patch(typed, "t.0", 7))["t"] == (7, 2)
+
+
+def test_mapper_profile() -> None:
+    m = bson.Mapper(profile=True)
+    assert m.profile and not bson.Mapper().profile
+    doc = {"a": 1, "b": {"c": "xy", "d": None}, "l": [1.5, Point(1)]}
+    expected = {
+        1: (2, 16), 2: (1, 7), 3: (2, 10), 4: (1, 5), 6: (1, 0), 16: (2, 8),
+    }
+    with m.profiling() as profile:
+        raw = m.marshal(doc)
+        assert m.unmarshal(raw) == bson.unmarshal(raw)
+    snapshot = m.profile_snapshot()
+    assert snapshot == profile.snapshot()
+    for direction in ("encode", "decode"):
+        stats = snapshot[direction]
+        assert {bt: (v["count"], v["bytes"]) for bt, v in stats.items()} == expected
+        assert all(v["ns"] >= 0 for v in stats.values())
+        assert snapshot[direction + "_depth"] == {1: 3, 2: 4, 3: 2}
+
+    with m.profiling():
+        m.marshal({"x": "y"})
+    snapshot = m.profile_snapshot()
+    assert list(snapshot["encode"]) == [2] and snapshot["encode"][2]["count"] == 1
+    assert snapshot["decode"] == {} and snapshot["decode_depth"] == {}
+    with pytest.raises(bson.MapperConfigError):
+        bson.Mapper().profile_snapshot()
+
+
+
+def test_block_archive(tmp_path: Any, monkeypatch: Any) -> None:
+    docs = [{"i": i, "s": "x" * (i % 50), "d": {"l": [i, None]}} for i in range(1000)]
+    path = tmp_path / "docs.bsz"
+    with bson.BlockWriter(path, block_bytes=4096) as writer:
+        for i, doc in enumerate(docs):
+            assert writer.write(doc) == i
+        assert len(writer) == 1000
+    with bson.BlockReader(path, workers=2) as reader:
+        assert len(reader) == 1000 and len(reader._counts) > 10
+        assert list(reader) == docs
+        assert reader[-1] == docs[-1] and reader[10:300:7] == docs[10:300:7]
+        with pytest.raises(IndexError):
+            reader[1000]
+
+        # Документ по номеру - распаковка только его блока, соседние документы берутся из того же блока
+        calls: list[int] = []
+        read_block = reader.read_block
+
+        def counted_read_block(b: int) -> bytes:
+            calls.append(b)
+            return read_block(b)
+
+        monkeypatch.setattr(reader, "read_block", counted_read_block)
+        assert reader[500] == docs[500] and reader[501] == docs[501]
+        assert calls == [bisect.bisect_right(reader._firsts, 500) - 1]
+
+    raw = path.read_bytes()
+    index_offset, blocks, magic = struct.unpack("<qq4s", raw[-20:])
+    assert magic == b"BSZ1" and index_offset + blocks * 24 + 20 == len(raw)
+    records = list(struct.iter_unpack("<qqq", raw[index_offset:-20]))
+    assert records[0][0] == 0 and sum(count for _, count, _ in records) == 1000
+    for (offset, count, first), (next_offset, _, next_first) in zip(records, records[1:]):
+        assert offset < next_offset and first + count == next_first
+
+
+def test_block_archive_empty_and_broken(tmp_path: Any) -> None:
+    path = tmp_path / "docs.bsz"
+    with bson.BlockWriter(path):
+        pass
+    with bson.BlockReader(path) as reader:
+        assert len(reader) == 0 and list(reader) == []
+    path.write_bytes(b"")
+    with pytest.raises(bson.BsonNotEnoughDataError):
+        bson.BlockReader(path)
+    with bson.BlockWriter(path) as writer:
+        writer.write({"a": 1})
+    raw = path.read_bytes()
+    path.write_bytes(raw[:-1] + b"2")
+    with pytest.raises(bson.BsonBrokenDataError):
+        bson.BlockReader(path)
+    path.write_bytes(b"\xff" * 4 + raw[4:])
+    with bson.BlockReader(path) as reader, pytest.raises(bson.BsonBrokenDataError):
+        reader[0]
+
+
+
 def inout_test(inp: Any, exp: Any, mapper: Any=None) -> None:
     if mapper is None:
         mapper = bson